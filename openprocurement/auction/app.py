@@ -120,6 +120,5 @@ def make_auctions_app(global_conf,
     auctions_server.config['HASH_SECRET_KEY'] = hash_secret_key
     sync_design(auctions_server.db)
     for entry_point in iter_entry_points(PKG_NAMESPACE):
-        plugin = entry_point.load()
-        plugin(components)
+        components.add_plugin(entry_point.name, entry_point.load)
     return auctions_server
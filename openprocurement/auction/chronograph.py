@@ -17,28 +17,35 @@ import argparse
 from yaml import load
 from zope.interface import implementer
 from pytz import timezone
-from gevent import sleep
+from gevent import sleep, spawn
 from gevent.pywsgi import WSGIServer
 from datetime import datetime, timedelta
+from time import time
 from urlparse import urlparse
 
-from openprocurement.auction.utils import FeedItem
+from openprocurement.auction.utils import FeedItem, timestamp_key
 from openprocurement.auction.core import components
 from openprocurement.auction.interfaces import (
     IAuctionsChronograph, IAuctionsManager
 )
-from openprocurement.auction.design import sync_design_chronograph
+from openprocurement.auction.design import (
+    sync_design_chronograph, start_date_chronograph_value,
+    start_time_chronograph
+)
 from openprocurement.auction.helpers.chronograph import (
-    get_server_name, AuctionScheduler
+    get_server_name, AuctionScheduler, MAX_AUCTION_START_TIME_RESERV
 )
 from openprocurement.auction.helpers.chronograph_http import chronograph_webapp
 from openprocurement.auction.helpers.couch import (
-    iterview, couchdb_dns_query_settings
+    iterview, iterchanges, couchdb_dns_query_settings
 )
 from openprocurement.auction.helpers.system import get_lisener
 
 
 LOGGER = logging.getLogger('Auction Chronograph')
+CHANGES_SINCE_SAVE_INTERVAL = 10
+SCHEDULING_HORIZON = 2 * 60 * 60
+SCHEDULING_HORIZON_REFRESH = 60
 
 
 @implementer(IAuctionsChronograph)
@@ -49,6 +56,18 @@ class AuctionsChronograph(object):
         self.config = config
         self.timezone = timezone(config['main']['timezone'])
         self.mapper = components.qA(self, IAuctionsManager)
+        self.use_changes_feed = config['main'].get('use_changes_feed', False)
+        self.changes_since_file = config['main'].get('changes_since_file')
+        self.scheduling_horizon_refresh = config['main'].get(
+            'scheduling_horizon_refresh', SCHEDULING_HORIZON_REFRESH)
+        self.scheduling_horizon = timedelta(seconds=config['main'].get(
+            'scheduling_horizon', SCHEDULING_HORIZON))
+        min_horizon = MAX_AUCTION_START_TIME_RESERV + \
+            timedelta(seconds=self.scheduling_horizon_refresh)
+        if self.scheduling_horizon and self.scheduling_horizon < min_horizon:
+            LOGGER.warning('Scheduling horizon is increased to {}'.format(
+                min_horizon))
+            self.scheduling_horizon = min_horizon
         self.server_name = get_server_name()
         LOGGER.info('Init node: {}'.format(self.server_name))
         self.init_database()
@@ -57,11 +76,11 @@ class AuctionsChronograph(object):
             self.init_web_app()
 
     def init_database(self):
-
-        sync_design_chronograph(couchdb_dns_query_settings(
+        self.db = couchdb_dns_query_settings(
             self.config['main']["couch_url"],
             self.config['main']['auctions_db']
-        ))
+        )
+        sync_design_chronograph(self.db)
 
     def init_scheduler(self):
         self.scheduler = AuctionScheduler(
@@ -92,6 +111,142 @@ class AuctionsChronograph(object):
             )
         self.server.start()
 
+    def schedule(self, auction_item):
+        datestamp = (
+            datetime.now(self.timezone) + timedelta(minutes=1)
+        ).isoformat()
+        # ADD FILTER BY VALUE
+        # {start: '2016-09-10T14:36:40.378777+03:00', test: false}
+        if self.owned_by_other(auction_item) or \
+                self.scheduler.unchanged(auction_item['id'],
+                                         auction_item['value']) or \
+                self.beyond_horizon(auction_item):
+            return
+        if datestamp < auction_item['value']['start']:
+            worker_cmd_provider = \
+                self.mapper(FeedItem(auction_item['value']))
+            if not worker_cmd_provider:
+                return
+            self.scheduler.schedule_auction(
+                auction_item['id'], auction_item['value'],
+                args=worker_cmd_provider(auction_item['id'])
+            )
+
+    def beyond_horizon(self, auction_item):
+        """Check that the auction starts later than the scheduling horizon.
+        Such auctions are not kept in the scheduler (the job is removed if
+        the auction was rescheduled) until load_scheduling_window picks
+        them up."""
+        if not self.scheduling_horizon:
+            return False
+        start = self.scheduler.convert_datetime(auction_item['value']['start'])
+        if start <= datetime.now(self.timezone) + self.scheduling_horizon:
+            return False
+        if self.scheduler.get_job(auction_item['id']):
+            LOGGER.info('Unschedule {} starting at {}'.format(
+                auction_item['id'], auction_item['value']['start']))
+            self.scheduler.unschedule_auction(auction_item['id'])
+        return True
+
+    def owned_by_other(self, auction_item):
+        """Check that the auction belongs to other node of the cluster.
+        The job is removed if the auction was rescheduled on this node
+        before the cluster changed. The owner keeps the job of the auction
+        it placed on other node, to start it if that node misses it."""
+        cluster = self.scheduler.cluster
+        if not cluster or cluster.owns(auction_item['id']) or \
+                cluster.owner(auction_item['id']) == cluster.server_name:
+            return False
+        if self.scheduler.get_job(auction_item['id']):
+            LOGGER.info('Unschedule {} owned by {}'.format(
+                auction_item['id'], cluster.owner(auction_item['id'])))
+            self.scheduler.unschedule_auction(auction_item['id'])
+        return True
+
+    def load_scheduling_window(self):
+        while not self.scheduler.exit:
+            now = datetime.now(self.timezone)
+            options = {'startkey': timestamp_key(now + timedelta(minutes=1))}
+            if self.scheduling_horizon:
+                options['endkey'] = timestamp_key(
+                    now + self.scheduling_horizon)
+            try:
+                for row in start_time_chronograph(self.db, **options):
+                    self.schedule({'id': row.id, 'value': row.value})
+            except Exception as e:
+                LOGGER.warning(
+                    'Failed to load scheduling window: {}'.format(repr(e)))
+            sleep(self.scheduling_horizon_refresh)
+
+    def run_view(self):
+        jobstore = self.scheduler.jobstore
+        start_key = jobstore.get_meta('view_start_key', 0) if jobstore else 0
+        if start_key:
+            LOGGER.info('Resume view from {}'.format(start_key))
+        saved_at = time()
+        for auction_item in iterview(self.config['main']["couch_url"],
+                                     self.config['main']['auctions_db'],
+                                     'chronograph/start_date',
+                                     start_key=start_key):
+            self.schedule(auction_item)
+            if jobstore and \
+                    time() - saved_at >= CHANGES_SINCE_SAVE_INTERVAL:
+                jobstore.set_meta('view_start_key', auction_item['key'])
+                saved_at = time()
+            if self.scheduler.exit:
+                break
+
+    def load_changes_since(self):
+        """Saved position of the changes feed. The feed is read from the
+        beginning unless the jobs are kept in the persistent job store,
+        as the auctions waiting since then would not be scheduled"""
+        if not self.scheduler.jobstore:
+            return 0
+        since = None
+        if self.changes_since_file and \
+                os.path.isfile(self.changes_since_file):
+            with open(self.changes_since_file) as since_file:
+                since = since_file.read().strip()
+        else:
+            since = self.scheduler.jobstore.get_meta('changes_since')
+        if since:
+            LOGGER.info('Resume changes feed from {}'.format(since))
+            return since
+        return 0
+
+    def save_changes_since(self, since):
+        if self.scheduler.jobstore and not self.scheduler.exit:
+            self.scheduler.jobstore.set_meta('changes_since', str(since))
+        if not self.changes_since_file:
+            return
+        try:
+            with open(self.changes_since_file, 'w') as since_file:
+                since_file.write(str(since))
+        except IOError as e:
+            LOGGER.warning(
+                'Failed to save changes feed sequence: {}'.format(repr(e)))
+
+    def run_changes_feed(self):
+        since = self.load_changes_since()
+        saved_at = time()
+        for change in iterchanges(self.config['main']["couch_url"],
+                                  self.config['main']['auctions_db'],
+                                  'chronograph/waiting', since=since):
+            since = change['seq']
+            try:
+                value = start_date_chronograph_value(change['doc'])
+            except (KeyError, IndexError, TypeError):
+                LOGGER.warning(
+                    'Skip auction {} without stages'.format(change['id']))
+            else:
+                self.schedule({'id': change['id'], 'value': value})
+            if time() - saved_at >= CHANGES_SINCE_SAVE_INTERVAL:
+                self.save_changes_since(since)
+                saved_at = time()
+            if self.scheduler.exit:
+                break
+        self.save_changes_since(since)
+
     def run(self):
 
         LOGGER.info('Starting node: {}'.format(self.server_name))
@@ -108,26 +263,14 @@ class AuctionsChronograph(object):
 
         gevent_signal(signal.SIGUSR1, sigusr1)
 
-        for auction_item in iterview(self.config['main']["couch_url"],
-                                     self.config['main']['auctions_db'],
-                                     'chronograph/start_date'):
-            datestamp = (
-                datetime.now(self.timezone) + timedelta(minutes=1)
-            ).isoformat()
-            # ADD FILTER BY VALUE
-            # {start: '2016-09-10T14:36:40.378777+03:00', test: false}
-            if datestamp < auction_item['value']['start']:
-                worker_cmd_provider = \
-                    self.mapper(FeedItem(auction_item['value']))
-                if not worker_cmd_provider:
-                    continue
-                self.scheduler.schedule_auction(
-                    auction_item['id'], auction_item['value'],
-                    args=worker_cmd_provider(auction_item['id'])
-                )
-
-            if self.scheduler.exit:
-                break
+        # The window is reloaded to pick up auctions which came within
+        # the horizon or passed to this node from other cluster nodes
+        if self.scheduling_horizon or self.scheduler.cluster:
+            spawn(self.load_scheduling_window)
+        if self.use_changes_feed:
+            self.run_changes_feed()
+        else:
+            self.run_view()
 
         while not self.scheduler.execution_stopped:
             sleep(10)
@@ -1,12 +1,13 @@
 import logging
 from zope import interface
-from zope.interface import registry
+from zope.interface import registry, providedBy
 from walkabout import PredicateDomain, PredicateMismatch
 
 from openprocurement.auction.interfaces import IComponents, IAuctionType, IFeedItem
 
 
 LOGGER = logging.getLogger(__name__)
+MATCH_CACHE_SIZE = 1024
 
 
 @interface.implementer(IComponents)
@@ -15,18 +16,80 @@ class AuctionComponents(registry.Components):
     def __init__(self, *args, **kw):
         super(AuctionComponents, self).__init__(*args, **kw)
         self._dispatch = PredicateDomain(IAuctionType, self)
+        self._predicate_names = []
+        self._match_cache = {}
+        self._lazy_plugins = {}
+        self._loaded_plugins = set()
 
-    def add_predicate(self, *args, **kw):
-        self._dispatch.add_predicate(*args, **kw)
+    def add_predicate(self, name, *args, **kw):
+        self._dispatch.add_predicate(name, *args, **kw)
+        self._predicate_names.append(name)
+        self._match_cache.clear()
 
     def add_auction(self, iface, **preds):
         self._dispatch.add_candidate(iface, IFeedItem, **preds)
+        self._match_cache.clear()
+
+    def add_plugin(self, name, loader, lazy=False):
+        """ Register plugin loader. Lazy plugins are loaded the first
+        time a feed item with predicate value equal to the plugin name
+        (i.e. procurementMethodType) is matched, so the entry point name
+        of a lazy plugin must be the procurementMethodType it registers.
+        A plugin registering other types is loaded only by an item of its
+        own name; use lazy=False for such plugins """
+        if name in self._loaded_plugins:
+            return
+        if lazy:
+            self._lazy_plugins[name] = loader
+        else:
+            self._load_plugin(name, loader)
+
+    def _load_plugin(self, name, loader):
+        self._lazy_plugins.pop(name, None)
+        self._loaded_plugins.add(name)
+        LOGGER.info('Load plugin {}'.format(name))
+        plugin = loader()
+        plugin(self)
+
+    def _load_lazy_plugins(self, inst):
+        for name in self._predicate_names:
+            value = inst.get(name)
+            if value in self._lazy_plugins:
+                self._load_plugin(value, self._lazy_plugins[value])
+
+    def _match_key(self, inst):
+        """ Dispatch depends only on interfaces provided by the item
+        and on values of the predicates fields """
+        key = (providedBy(inst),) + tuple(
+            inst.get(name) for name in self._predicate_names
+        )
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
 
     def match(self, inst):
+        key = self._match_key(inst)
+        if key is not None and key in self._match_cache:
+            return self._match_cache[key]
+        if self._lazy_plugins:
+            self._load_lazy_plugins(inst)
         try:
-            return self._dispatch.lookup(inst)
+            result = self._dispatch.lookup(inst)
         except PredicateMismatch:
-            pass
+            result = None
+        if result is None and self._lazy_plugins:
+            LOGGER.warning(
+                'No plugin matched {}, not loaded lazy plugins: {}'.format(
+                    dict((name, inst.get(name))
+                         for name in self._predicate_names),
+                    ', '.join(sorted(self._lazy_plugins))))
+        if key is not None:
+            if len(self._match_cache) >= MATCH_CACHE_SIZE:
+                self._match_cache.clear()
+            self._match_cache[key] = result
+        return result
 
     def adapter(self, provides, adapts, name=""):
         """ TODO: create decorator for such thinks """
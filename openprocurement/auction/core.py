@@ -2,9 +2,11 @@ import logging.config
 import iso8601
 
 from datetime import datetime
-from time import mktime, time
+from time import time
+from dateutil.tz import tzlocal
 from gevent.subprocess import check_call
 from pkg_resources import iter_entry_points
+from zope.interface import implementer
 
 from openprocurement.auction.systemd_msgs_ids import (
     DATA_BRIDGE_PLANNING_TENDER_SKIP,
@@ -14,26 +16,24 @@ from openprocurement.auction.systemd_msgs_ids import (
     DATA_BRIDGE_RE_PLANNING_TENDER_ALREADY_PLANNED,
     DATA_BRIDGE_RE_PLANNING_LOT_ALREADY_PLANNED,
 )
-from openprocurement.auction.design import endDate_view, startDate_view,\
-    PreAnnounce_view
+from openprocurement.auction.design import PreAnnounce_by_id_view
 from openprocurement.auction.utils import do_until_success, \
     prepare_auction_worker_cmd
 from openprocurement.auction.auctions_server import auctions_server
 from openprocurement.auction.components import AuctionComponents
 from openprocurement.auction.predicates import ProcurementMethodType
 from openprocurement.auction.interfaces import IAuctionsManager,\
-    IAuctionsChronograph, IAuctionDatabridge, IAuctionsServer
+    IAuctionsChronograph, IAuctionDatabridge, IAuctionsServer, IAuctionPlanner
 
 
 SIMPLE_AUCTION_TYPE = 0
 SINGLE_LOT_AUCTION_TYPE = 1
 MULTILOT_AUCTION_ID = "{0[id]}_{1[id]}"  # {TENDER_ID}_{LOT_ID}
-LOGGER = logging.getLogger('Openprocurement Auction')
+# same logger as openprocurement.auction.worker.auction uses, without
+# importing the worker
+LOGGER = logging.getLogger('Auction Worker')
 PKG_NAMESPACE = "openprocurement.auction.auctions"
 
-
-from openprocurement.auction.worker.auction import LOGGER
-
 components = AuctionComponents()
 components.add_predicate('procurementMethodType', ProcurementMethodType)
 components.registerUtility(auctions_server, IAuctionsServer)
@@ -43,11 +43,12 @@ class AuctionManager(object):
     def __init__(self, for_):
         self.for_ = for_
         self.plugins = self.for_.config.get('main', {}).get('plugins') or []
+        lazy = self.for_.config.get('main', {}).get('lazy_plugins', False)
         for entry_point in iter_entry_points(PKG_NAMESPACE):
             type_ = entry_point.name
             if type_ in self.plugins or type_ == 'default':
-                plugin = entry_point.load()
-                plugin(components)
+                components.add_plugin(type_, entry_point.load,
+                                      lazy=lazy and type_ != 'default')
 
     def __repr__(self):
         return "<Auctions mapper for: {}>".format(self.for_)
@@ -124,21 +125,16 @@ class Planning(object):
 
                 start_date = iso8601.parse_date(self.item['auctionPeriod']['startDate'])
                 start_date = start_date.astimezone(self.bridge.tz)
-                auctions_start_in_date = startDate_view(
-                    self.bridge.db,
-                    key=(mktime(start_date.timetuple()) + start_date.microsecond / 1E6) * 1000
-                )
                 if datetime.now(self.bridge.tz) > start_date:
                     LOGGER.info("Tender {} start date in past. Skip it for planning".format(self.item['id']),
                                 extra={'MESSAGE_ID': DATA_BRIDGE_PLANNING_TENDER_SKIP})
                     raise StopIteration
-                # TODO: Find out about the value of field tenders_ids_list
-                # TODO: It is not initialized but used.
-                if self.bridge.re_planning and self.item['id'] in self.tenders_ids_list:
+                if self.bridge.re_planning and self.item['id'] in self.bridge.re_planned_ids:
+                    self.bridge.re_planning_skipped += 1
                     LOGGER.info("Tender {} already planned while replanning".format(self.item['id']),
                                 extra={'MESSAGE_ID': DATA_BRIDGE_RE_PLANNING_TENDER_ALREADY_PLANNED})
                     raise StopIteration
-                if not self.bridge.re_planning and [row.id for row in auctions_start_in_date.rows if row.id == self.item['id']]:
+                if not self.bridge.re_planning and self.bridge.auctions_index.is_planned(self.item['id'], start_date):
                     LOGGER.info("Tender {} already planned on the same date".format(self.item['id']),
                                 extra={'MESSAGE_ID': DATA_BRIDGE_PLANNING_TENDER_ALREADY_PLANNED})
                     raise StopIteration
@@ -149,10 +145,6 @@ class Planning(object):
                             and 'startDate' in lot['auctionPeriod'] and 'endDate' not in lot['auctionPeriod']:
                         start_date = iso8601.parse_date(lot['auctionPeriod']['startDate'])
                         start_date = start_date.astimezone(self.bridge.tz)
-                        auctions_start_in_date = startDate_view(
-                            self.bridge.db,
-                            key=(mktime(start_date.timetuple()) + start_date.microsecond / 1E6) * 1000
-                        )
                         if datetime.now(self.bridge.tz) > start_date:
                             LOGGER.info(
                                 "Start date for lot {} in tender {} is in past. Skip it for planning".format(
@@ -161,36 +153,38 @@ class Planning(object):
                             )
                             raise StopIteration
                         auction_id = MULTILOT_AUCTION_ID.format(self.item, lot)
-                        if self.bridge.re_planning and auction_id in self.tenders_ids_list:
+                        if self.bridge.re_planning and auction_id in self.bridge.re_planned_ids:
+                            self.bridge.re_planning_skipped += 1
                             LOGGER.info("Tender {} already planned while replanning".format(auction_id),
                                         extra={'MESSAGE_ID': DATA_BRIDGE_RE_PLANNING_LOT_ALREADY_PLANNED})
                             raise StopIteration
-                        elif not self.bridge.re_planning and [row.id for row in auctions_start_in_date.rows if row.id == auction_id]:
+                        elif not self.bridge.re_planning and self.bridge.auctions_index.is_planned(auction_id, start_date):
                             LOGGER.info("Tender {} already planned on same date".format(auction_id),
                                         extra={'MESSAGE_ID': DATA_BRIDGE_PLANNING_LOT_ALREADY_PLANNED})
                             raise StopIteration
                         yield ("planning", str(self.item["id"]), str(lot["id"]))
         if status == "active.qualification" and 'lots' in self.item:
-            for lot in self.item['lots']:
-                if lot["status"] == "active":
-                    is_pre_announce = PreAnnounce_view(self.bridge.db)
-                    auction_id = MULTILOT_AUCTION_ID.format(self.item, lot)
-                    if [row.id for row in is_pre_announce.rows if row.id == auction_id]:
+            lots = [(MULTILOT_AUCTION_ID.format(self.item, lot), lot)
+                    for lot in self.item['lots'] if lot["status"] == "active"]
+            if lots:
+                pre_announce = set(row.id for row in PreAnnounce_by_id_view(
+                    self.bridge.db, keys=[auction_id for auction_id, _ in lots]
+                ))
+                for auction_id, lot in lots:
+                    if auction_id in pre_announce:
                         yield ('announce', self.item['id'], lot['id'])
             raise StopIteration
         if status == "cancelled":
-            future_auctions = endDate_view(
-                self.bridge.db, startkey=time() * 1000
-            )
+            now = time() * 1000
             if 'lots' in self.item:
                 for lot in self.item['lots']:
                     auction_id = MULTILOT_AUCTION_ID.format(self.item, lot)
-                    if auction_id in [i.id for i in future_auctions]:
+                    if self.bridge.auctions_index.is_scheduled(auction_id, now):
                         LOGGER.info('Tender {0} selected for cancellation'.format(self.item['id']))
                         yield ('cancel', self.item['id'], lot['id'])
                 raise StopIteration
             else:
-                if self.item["id"] in [i.id for i in future_auctions]:
+                if self.bridge.auctions_index.is_scheduled(self.item["id"], now):
                     LOGGER.info('Tender {0} selected for cancellation'.format(self.item['id']))
                     yield ('cancel', self.item['id'], "")
                 raise StopIteration
@@ -201,7 +195,31 @@ class Planning(object):
 
     __str__ = __repr__
 
+    def get_planner(self):
+        if not self.bridge.in_process_planning:
+            return
+        return components.queryUtility(
+            IAuctionPlanner,
+            name=self.item.get('procurementMethodType', 'default') or 'default'
+        )
+
     def __call__(self, cmd, tender_id, with_api_version=None, lot_id=None):
+        planner = self.get_planner()
+        if planner is not None:
+            try:
+                result = planner(self.bridge, cmd, tender_id, self.item,
+                                 lot_id=lot_id)
+            except NotImplementedError:
+                # the planner leaves this command to the auction worker
+                pass
+            except Exception as e:
+                LOGGER.error(
+                    "In-process {} of {} failed: {}. Fallback to "
+                    "auction worker".format(cmd, tender_id, repr(e)))
+            else:
+                LOGGER.info("Auction command {} result: {}".format(cmd, result))
+                return
+
         params = prepare_auction_worker_cmd(
             self.bridge,
             tender_id,
@@ -217,3 +235,33 @@ class Planning(object):
         )
 
         LOGGER.info("Auction command {} result: {}".format(params[1], result))
+
+
+@implementer(IAuctionPlanner)
+class DefaultPlanner(object):
+    """In-process planner of the default auction type.
+
+    Cancellation only updates the auction document, so it is done with the
+    bridge database. Planning and announcement build the document from the
+    worker templates and raise NotImplementedError to be left to the
+    auction worker.
+    """
+
+    def __call__(self, bridge, cmd, tender_id, item, lot_id=None):
+        if cmd != 'cancel':
+            raise NotImplementedError(cmd)
+        if lot_id:
+            document_id = MULTILOT_AUCTION_ID.format({'id': tender_id},
+                                                     {'id': lot_id})
+        else:
+            document_id = tender_id
+        doc = bridge.db.get(document_id)
+        if not doc:
+            LOGGER.info("Auction {} not found".format(document_id))
+            return
+        doc['current_stage'] = -100
+        doc['endDate'] = datetime.now(tzlocal()).isoformat()
+        bridge.db.save(doc)
+        LOGGER.info("Change auction {} status to 'canceled'".format(
+            document_id))
+        return document_id
@@ -11,11 +11,14 @@ import logging
 import logging.config
 import os
 import argparse
+from time import time
 from urlparse import urljoin
 from zope.interface import implementer
 from yaml import load
 from couchdb import Database, Session
+from requests import Session as APISession
 from dateutil.tz import tzlocal
+from gevent import spawn
 
 from openprocurement.auction.interfaces import\
     IAuctionDatabridge, IAuctionsManager
@@ -23,9 +26,18 @@ from openprocurement.auction.core import components
 from openprocurement.auction.utils import FeedItem
 
 from openprocurement.auction.systemd_msgs_ids import\
-    DATA_BRIDGE_PLANNING_DATA_SYNC, DATA_BRIDGE_PLANNING_START_BRIDGE
+    DATA_BRIDGE_PLANNING_DATA_SYNC, DATA_BRIDGE_PLANNING_START_BRIDGE,\
+    DATA_BRIDGE_PLANNING_DATA_SYNC_RESUME,\
+    DATA_BRIDGE_RE_PLANNING_START_BRIDGE, DATA_BRIDGE_RE_PLANNING_PROGRESS,\
+    DATA_BRIDGE_RE_PLANNING_FINISHED
 from openprocurement_client.sync import ResourceFeeder
 from openprocurement.auction.design import sync_design
+from openprocurement.auction.helpers.databridge import PlanningPool,\
+    AuctionsIndex, FeedCheckpoint, CheckpointResourceFeeder, BloomFilter,\
+    RateLimiter, FeedItemsCache, PLANNING_CONCURRENCY,\
+    PLANNING_STATS_INTERVAL, CHECKPOINT_INTERVAL, RE_PLANNING_RATE,\
+    RE_PLANNING_CAPACITY, RE_PLANNING_PROGRESS_INTERVAL,\
+    RE_PLANNING_DONE_CHECK, FEED_CACHE_SIZE
 
 
 LOGGER = logging.getLogger(__name__)
@@ -46,14 +58,30 @@ class AuctionsDataBridge(object):
 
     """Auctions Data Bridge"""
 
-    def __init__(self, config, re_planning=False, debug=False):
+    def __init__(self, config, re_planning=False, debug=False,
+                 from_scratch=False):
         super(AuctionsDataBridge, self).__init__()
         self.config = config
-        self.tenders_ids_list = []
         self.tz = tzlocal()
         self.debug = debug
         self.mapper = components.qA(self, IAuctionsManager)
         self.re_planning = re_planning
+        # auctions planned during current re-planning pass
+        self.re_planned_ids = BloomFilter(
+            capacity=int(self.config['main'].get(
+                're_planning_capacity', RE_PLANNING_CAPACITY)))
+        # auctions skipped as found in re_planned_ids, false positives of
+        # the filter included
+        self.re_planning_skipped = 0
+        self.re_planning_limiter = RateLimiter(
+            float(self.config['main'].get('re_planning_rate',
+                                          RE_PLANNING_RATE)))
+        self.re_planning_progress_interval = float(self.config['main'].get(
+            're_planning_progress_interval', RE_PLANNING_PROGRESS_INTERVAL))
+        self.re_planning_done_check = float(self.config['main'].get(
+            're_planning_done_check', RE_PLANNING_DONE_CHECK))
+        self.in_process_planning = self.config['main'].get(
+            'in_process_planning', True)
         DEFAULT_RETRIEVERS_PARAMS.update(
             self.config.get('main').get('retrievers_params', {}))
         self.couch_url = urljoin(
@@ -63,17 +91,74 @@ class AuctionsDataBridge(object):
         self.db = Database(self.couch_url,
                            session=Session(retry_delays=range(10)))
         sync_design(self.db)
-        self.feeder = ResourceFeeder(
+        self.auctions_index = AuctionsIndex(self.db, logger=LOGGER)
+        self.auctions_index.build()
+        # shared with in-process planners (see IAuctionPlanner)
+        self.api_session = APISession()
+        self.feeder = CheckpointResourceFeeder(
             host=self.config_get('resource_api_server'),
             resource=self.config_get('resource_name'),
             version=self.config_get('resource_api_version'), key='',
             extra_params=API_EXTRA,
             retrievers_params=DEFAULT_RETRIEVERS_PARAMS
         )
+        self.feeder.session = self.api_session
+        self.checkpoint = FeedCheckpoint(
+            self.db, self.config_get('resource_name'), logger=LOGGER)
+        self.checkpoint_interval = int(self.config['main'].get(
+            'checkpoint_interval', CHECKPOINT_INTERVAL))
+        self._pending_checkpoint = None
+        self._items_since_checkpoint = 0
+        if from_scratch:
+            self.checkpoint.clear()
+        else:
+            self.feeder.checkpoint = self.checkpoint.load()
+            if self.feeder.checkpoint:
+                LOGGER.info('Resume feed from {}'.format(
+                    self.feeder.checkpoint),
+                    extra={'MESSAGE_ID': DATA_BRIDGE_PLANNING_DATA_SYNC_RESUME})
+        stats_interval = float(self.config['main'].get(
+            'planning_stats_interval', PLANNING_STATS_INTERVAL))
+        self.planning_pool = PlanningPool(
+            size=int(self.config['main'].get('planning_concurrency',
+                                             PLANNING_CONCURRENCY)),
+            stats_interval=stats_interval,
+            logger=LOGGER
+        )
+        self.feed_cache = FeedItemsCache(
+            API_EXTRA['opt_fields'].split(','),
+            size=int(self.config['main'].get('feed_cache_size',
+                                             FEED_CACHE_SIZE)),
+            stats_interval=stats_interval,
+            logger=LOGGER
+        )
 
     def config_get(self, name):
         return self.config['main'][name]
 
+    def _feed_queue_empty(self):
+        queue = getattr(self.feeder, 'queue', None)
+        return queue is None or queue.empty()
+
+    def save_checkpoint(self):
+        """Save feed offsets once every command of the items fetched before
+        them has been executed by the planning pool"""
+        if self._pending_checkpoint:
+            seq, offsets = self._pending_checkpoint
+            if self.planning_pool.done_before(seq):
+                self.checkpoint.save(offsets)
+                self.feeder.checkpoint = offsets
+                self._pending_checkpoint = None
+        self._items_since_checkpoint += 1
+        if self._pending_checkpoint is None and \
+                self._items_since_checkpoint >= self.checkpoint_interval and \
+                self._feed_queue_empty():
+            offsets = self.feeder.offsets
+            if offsets['forward']:
+                self._pending_checkpoint = (self.planning_pool.queued,
+                                            offsets)
+                self._items_since_checkpoint = 0
+
     def run(self):
         if self.re_planning:
             self.run_re_planning()
@@ -83,12 +168,19 @@ class AuctionsDataBridge(object):
                     extra={'MESSAGE_ID': DATA_BRIDGE_PLANNING_START_BRIDGE})
         LOGGER.info('Start data sync...',
                     extra={'MESSAGE_ID': DATA_BRIDGE_PLANNING_DATA_SYNC})
+        self.auctions_index.start_following()
         for item in self.feeder.get_resource_items():
+            if not self.feed_cache.changed(item):
+                self.save_checkpoint()
+                continue
             # magic goes here
             feed = FeedItem(item)
             planning = self.mapper(feed)
             if not planning:
+                self.feed_cache.remember(item)
+                self.save_checkpoint()
                 continue
+            commands = []
             for cmd, item_id, lot_id in planning:
                 if lot_id:
                     LOGGER.info('Lot {} of tender {} selected for {}'.format(
@@ -96,35 +188,105 @@ class AuctionsDataBridge(object):
                 else:
                     LOGGER.info('Tender {} selected for {}'.format(item_id,
                                                                    cmd))
+                commands.append((cmd, item_id, lot_id))
+            if commands:
+                self.planning_pool.add(commands[0][1], self.plan, item,
+                                       planning, commands)
+            else:
+                self.feed_cache.remember(item)
+            self.save_checkpoint()
+        self.planning_pool.join()
+        self.planning_pool.report(force=True)
+        self.feed_cache.report(force=True)
+        self.auctions_index.stop_following()
+
+    def plan(self, item, planning, commands):
+        """Run planning commands of the feed item, the item is cached as
+        planned only if every command succeeded"""
+        planned = True
+        for cmd, item_id, lot_id in commands:
+            try:
                 planning(cmd, item_id, lot_id=lot_id)
+            except Exception as e:
+                LOGGER.error('Planning of tender {} failed: {}'.format(
+                    item_id, repr(e)))
+                planned = False
+        if planned:
+            self.feed_cache.remember(item)
+
+    def re_plan(self, item):
+        """Plan auctions of the feed item again, return the count of them"""
+        planned = 0
+        planning = self.mapper(FeedItem(item))
+        if planning:
+            for cmd, item_id, lot_id in planning:
+                if cmd != 'planning':
+                    continue
+                if lot_id:
+                    LOGGER.info(
+                        'Lot {} of tender {} selected for re-planning'
+                        .format(lot_id, item_id))
+                else:
+                    LOGGER.info('Tender {} selected for re-planning'
+                                .format(item_id))
+                self.re_planning_limiter.wait()
+                self.planning_pool.add(item_id, planning, cmd, item_id,
+                                       lot_id=lot_id)
+                self.re_planned_ids.add(
+                    '{}_{}'.format(item_id, lot_id) if lot_id
+                    else item_id)
+                planned += 1
+        return planned
 
     def run_re_planning(self):
-        pass
-        # self.re_planning = True
-        # self.offset = ''
-        # LOGGER.info(
-        #     'Start Auctions Bridge for re-planning...',
-        #     extra={'MESSAGE_ID': DATA_BRIDGE_RE_PLANNING_START_BRIDGE})
-        # for tender_item in self.get_teders_list(re_planning=True):
-        #     LOGGER.debug('Tender {} selected for re-planning'.format(
-        #         tender_item))
-        #     for planning_data in self.get_teders_list():
-        #         if len(planning_data) == 1:
-        #             LOGGER.info('Tender {0} selected for planning'.format(
-        #                 *planning_data))
-        #             self.start_auction_worker_cmd('planning',
-        #                                           planning_data[0])
-        #         elif len(planning_data) == 2:
-        #             LOGGER.info(
-        #                 'Lot {1} of tender {0} selected for planning'.format(
-        #                     *planning_data))
-        #             self.start_auction_worker_cmd('planning',
-        #                                           planning_data[0],
-        #                                           lot_id=planning_data[1])
-        #         self.tenders_ids_list.append(tender_item['id'])
-        #     sleep(1)
-        # LOGGER.info("Re-planning auctions finished",
-        #             extra={'MESSAGE_ID': DATA_BRIDGE_RE_PLANNING_FINISHED})
+        LOGGER.info(
+            'Start Auctions Bridge for re-planning...',
+            extra={'MESSAGE_ID': DATA_BRIDGE_RE_PLANNING_START_BRIDGE})
+        self.feeder.checkpoint = None
+        started_at = reported_at = time()
+        stats = {'items': 0, 'planned': 0, 'busy': False}
+
+        def read_feed():
+            for item in self.feeder.get_resource_items():
+                stats['busy'] = True
+                stats['items'] += 1
+                stats['planned'] += self.re_plan(item)
+                stats['busy'] = False
+
+        # the feed is checked for completion also while it brings no items
+        reader = spawn(read_feed)
+        while not reader.ready():
+            reader.join(timeout=self.re_planning_done_check)
+            now = time()
+            if now - reported_at >= self.re_planning_progress_interval:
+                reported_at = now
+                LOGGER.info(
+                    'Re-planning: {} feed items, {} auctions planned, '
+                    '{} skipped as planned, {:.2f} items/s'.format(
+                        stats['items'], stats['planned'],
+                        self.re_planning_skipped,
+                        stats['items'] / (now - started_at)),
+                    extra={'MESSAGE_ID': DATA_BRIDGE_RE_PLANNING_PROGRESS})
+            if not stats['busy'] and self.feeder.backward_done and \
+                    self._feed_queue_empty():
+                reader.kill()
+        self.planning_pool.join()
+        # every planned auction was looked up in the filter before it was
+        # added, so each lookup could give a false positive (upper bound)
+        false_positives = \
+            self.re_planned_ids.false_positive_rate * stats['planned']
+        LOGGER.info(
+            'Re-planning auctions finished: {} feed items, {} auctions '
+            'planned, {} skipped as planned (up to {:.1f} of them by false '
+            'positives of the filter)'.format(
+                stats['items'], stats['planned'], self.re_planning_skipped,
+                false_positives),
+            extra={'MESSAGE_ID': DATA_BRIDGE_RE_PLANNING_FINISHED})
+        if len(self.re_planned_ids) > self.re_planned_ids.capacity:
+            LOGGER.warning(
+                'Re-planning filter is over capacity ({} of {} auctions), '
+                'raise re_planning_capacity'.format(
+                    len(self.re_planned_ids), self.re_planned_ids.capacity))
 
 
 def main():
@@ -133,12 +295,16 @@ def main():
     parser.add_argument(
         '--re-planning', action='store_true', default=False,
         help='Not ignore auctions which already scheduled')
+    parser.add_argument(
+        '--from-scratch', action='store_true', default=False,
+        help='Ignore saved feed checkpoint and resync the whole feed')
     params = parser.parse_args()
     if os.path.isfile(params.config):
         with open(params.config) as config_file_obj:
             config = load(config_file_obj.read())
         logging.config.dictConfig(config)
-        bridge = AuctionsDataBridge(config, re_planning=params.re_planning)
+        bridge = AuctionsDataBridge(config, re_planning=params.re_planning,
+                                    from_scratch=params.from_scratch)
         bridge.run()
 
 
@@ -16,10 +16,50 @@ start_date_chronograph = ViewDefinition(
     open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'design_files/start_date.js')).read()
 )
 
+start_time_chronograph = ViewDefinition(
+    'chronograph',
+    'start_time',
+    open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'design_files/start_time.js')).read()
+)
+
+
+# Filter for the _changes feed, selects the same documents as
+# chronograph/start_date view
+waiting_filter_chronograph = '''function(doc, req) {
+    return (doc.current_stage||0) == -1;
+}
+'''
+
+
+def start_date_chronograph_value(doc):
+    """Value emitted by chronograph/start_date view (design_files/start_date.js)
+    for the document
+
+    >>> value = start_date_chronograph_value({'stages': [{'start': '2017'}]})
+    >>> value['start'], value['auction_type'], value['api_version']
+    ('2017', 'default', None)
+    """
+    return {
+        "start": doc['stages'][0]['start'],
+        "mode": doc.get('mode') or "",
+        "api_version": doc.get('TENDERS_API_VERSION') or None,
+        "auction_type": doc.get('auction_type') or "default",
+        "procurementMethodType": doc.get('procurementMethodType') or ""
+    }
+
 
 def sync_design_chronograph(db):
-    views = [start_date_chronograph]
+    views = [start_date_chronograph, start_time_chronograph]
     ViewDefinition.sync_many(db, views, remove_missing=True, callback=add_index_options)
+    while True:
+        design = db.get('_design/chronograph')
+        if design.get('filters', {}).get('waiting') == waiting_filter_chronograph:
+            return
+        design.setdefault('filters', {})['waiting'] = waiting_filter_chronograph
+        try:
+            return db.save(design)
+        except HTTPError:
+            sleep(randint(0, 2000) / 1000.0)
 
 
 endDate_view = ViewDefinition(
@@ -54,9 +94,23 @@ PreAnnounce_view = ViewDefinition(
     '''
 )
 
+# Keyed by auction id to check several auctions with one `keys` request.
+# PreAnnounce_view is kept for compatibility.
+PreAnnounce_by_id_view = ViewDefinition(
+    'auctions',
+    'PreAnnounce_by_id',
+    ''' function(doc) {
+            if ((doc.stages.length - 2) == doc.current_stage){
+                emit(doc._id, null);
+            }
+        }
+    '''
+)
+
 
 def sync_design(db):
-    views = [endDate_view, startDate_view, PreAnnounce_view]
+    views = [endDate_view, startDate_view, PreAnnounce_view,
+             PreAnnounce_by_id_view]
     for view in views:
         view.sync(db)
     while True:
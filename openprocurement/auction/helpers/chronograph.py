@@ -1,19 +1,37 @@
 from apscheduler.executors.gevent import GeventExecutor
 from requests import get
-from .system import free_memory
-from gevent import sleep
+from .system import ResourceMonitor, RESOURCE_MONITOR_INTERVAL
+from .jobstore import SQLiteJobStore
+from .prefork import WarmWorkerPool, WARM_POOL_PRELOAD
+from .workers import (
+    ChildSupervisor, WorkerAccounting, AdmissionController, WORKERS_SAMPLE_INTERVAL,
+    ADMISSION_EWMA_ALPHA, ADMISSION_DEFAULT_RSS, ADMISSION_DEFER
+)
+from .cluster import (
+    ClusterMembership, NodeSession, LockManager, NODE_SESSION_TTL,
+    CLUSTER_REFRESH, LOCK_WINDOW
+)
+from gevent import sleep, spawn
 from logging import getLogger
 from random import random
 import consul
+import sys
 import iso8601
 from datetime import timedelta, datetime
 from apscheduler.schedulers.gevent import GeventScheduler
 from gevent.subprocess import Popen
 from apscheduler.schedulers import SchedulerNotRunningError
+from apscheduler.jobstores.base import JobLookupError
+from apscheduler.events import EVENT_JOB_REMOVED, EVENT_ALL_JOBS_REMOVED
 from uuid import uuid4
+from calendar import timegm
+from collections import Counter
+from heapq import heappop, heappush
+from time import time
 
 LOCK_RETRIES = 6
 SLEEP_BETWEEN_TRIES_LOCK = 10
+SHARD_FALLBACK_DELAY = 30
 WORKER_TIME_RUN = 16 * 60
 
 AWS_META_DATA_URL = 'http://169.254.169.254/latest/meta-data/instance-id'
@@ -32,6 +50,65 @@ def get_server_name():
     return SERVER_NAME_PREFIX.format(suffix)
 
 
+class LaunchSlots(object):
+    """Spreads launches of auction workers over time.
+
+    Every auction gets the first second since the earliest launch time
+    with less than ``rate`` launches planned, but not later than
+    ``min_lead`` before the auction start.
+    """
+
+    def __init__(self, rate, min_lead=MIN_AUCTION_START_TIME_RESERV,
+                 timezone=None):
+        self.rate = rate
+        self.min_lead = min_lead
+        self.timezone = timezone
+        self.slots = Counter()
+        self.launches = {}
+        # (second, document_id) of reservations, earliest first; entries of
+        # released or moved launches are skipped when they are popped
+        self.expiry = []
+
+    def release(self, document_id):
+        second = self.launches.pop(document_id, None)
+        if second is not None:
+            self.slots[second] -= 1
+            if self.slots[second] <= 0:
+                del self.slots[second]
+
+    def prune(self, now):
+        while self.expiry and self.expiry[0][0] < now:
+            second, document_id = heappop(self.expiry)
+            if self.launches.get(document_id) == second:
+                self.release(document_id)
+
+    def reserve(self, document_id, earliest, start):
+        self.release(document_id)
+        first = timegm(earliest.utctimetuple())
+        if earliest.microsecond:
+            first += 1
+        # only launches which are already past are forgotten
+        self.prune(int(time()))
+        last = max(timegm((start - self.min_lead).utctimetuple()), first)
+        seconds = xrange(first, last + 1)
+        second = next((s for s in seconds if self.slots[s] < self.rate),
+                      None)
+        if second is None:
+            second = min(seconds, key=self.slots.__getitem__)
+        self.slots[second] += 1
+        self.launches[document_id] = second
+        heappush(self.expiry, (second, document_id))
+        return datetime.fromtimestamp(second, earliest.tzinfo)
+
+    def histogram(self):
+        """Planned launches per minute"""
+        minutes = Counter()
+        for second, count in self.slots.items():
+            minutes[second - second % 60] += count
+        return [(datetime.fromtimestamp(minute, self.timezone).isoformat(),
+                 minutes[minute]) for minute in sorted(minutes)]
+
+
 class AuctionExecutor(GeventExecutor):
 
     def start(self, scheduler, alias):
@@ -66,38 +143,226 @@ class AuctionExecutor(GeventExecutor):
                 del self._instances[job_id]
 
 
+def schedule_signature(view_value):
+    """Fields of the view value the auction job is built from"""
+    return (view_value['start'], view_value.get('mode'),
+            view_value.get('api_version'), view_value.get('auction_type'),
+            view_value.get('procurementMethodType'))
+
+
+def run_auction(**kwargs):
+    """Job function of the auctions (jobs of bound methods can not be kept
+    in a persistent job store)"""
+    return AuctionScheduler.current.run_auction_func(**kwargs)
+
+
 class AuctionScheduler(GeventScheduler):
+    current = None
+
     def __init__(self, server_name, config,
                  limit_auctions=500,
                  limit_free_memory=0.15,
                  logger=getLogger(__name__),
                  *args, **kwargs):
+        jobstore_path = config['main'].get('jobstore_path')
+        if jobstore_path:
+            kwargs['jobstores'] = {'default': SQLiteJobStore(jobstore_path)}
         super(AuctionScheduler, self).__init__(*args, **kwargs)
+        AuctionScheduler.current = self
         self.server_name = server_name
         self.config = config
         self.execution_stopped = False
         self.use_consul = self.config.get('main', {}).get('use_consul', True)
+        self.logger = logger
+        self.cluster = None
         if self.use_consul:
             self.consul = consul.Consul()
-        self.logger = logger
+            self.session = NodeSession(
+                self.consul, self.server_name,
+                ttl=self.config['main'].get(
+                    'consul_session_ttl', NODE_SESSION_TTL),
+                logger=logger)
+            if self.config['main'].get('sharding', False):
+                self.cluster = ClusterMembership(
+                    self.consul, self.server_name, self.session,
+                    refresh=self.config['main'].get(
+                        'cluster_refresh', CLUSTER_REFRESH),
+                    load=self.node_load, on_placement=self.on_placement,
+                    logger=logger)
+        self._shard_fallback_delay = self.config['main'].get(
+            'shard_fallback_delay', SHARD_FALLBACK_DELAY)
+        self.locks = None
+        if self.use_consul:
+            lock_window = self.config['main'].get('lock_window', LOCK_WINDOW)
+            if lock_window:
+                self.locks = LockManager(self.consul, self.session,
+                                         window=lock_window, logger=logger)
+        self._locks_claimer = None
+        # greenlets watching locks held by other nodes
+        self.lock_watchers = {}
         self._limit_pool_lock = self._create_lock()
         self._limit_auctions = self.config['main'].get('limit_auctions',
                                                        int(limit_auctions))
         self._limit_free_memory = self.config['main'].get(
             'limit_free_memory', float(limit_free_memory)
         )
+        self._limit_cpu_load = self.config['main'].get('limit_cpu_load')
+        self._limit_processes = self.config['main'].get('limit_processes')
+        self.resources = ResourceMonitor(
+            interval=self.config['main'].get(
+                'resource_monitor_interval', RESOURCE_MONITOR_INTERVAL),
+            logger=logger)
         self._count_auctions = 0
         self.exit = False
         self.processes = {}
+        # signatures of the scheduled auctions (see schedule_signature),
+        # so unchanged view rows are skipped without job store lookups
+        self.scheduled = {}
+        self.schedule_stats = Counter()
+        self.add_listener(self._job_removed,
+                          EVENT_JOB_REMOVED | EVENT_ALL_JOBS_REMOVED)
+        # documents with running workers
+        self.active = set()
+        self.supervisor = ChildSupervisor(logger=logger)
+        self.workers = WorkerAccounting(
+            sample_interval=self.config['main'].get(
+                'workers_sample_interval', WORKERS_SAMPLE_INTERVAL),
+            logger=logger)
+        self.admission = None
+        if self.config['main'].get('admission_control', False):
+            self.admission = AdmissionController(
+                alpha=self.config['main'].get(
+                    'admission_ewma_alpha', ADMISSION_EWMA_ALPHA),
+                default_rss=self.config['main'].get(
+                    'admission_default_rss', ADMISSION_DEFAULT_RSS),
+                logger=logger)
+        self._admission_defer = timedelta(seconds=self.config['main'].get(
+            'admission_defer', ADMISSION_DEFER))
+        self.launch_slots = None
+        launch_rate = self.config['main'].get('launch_rate', 0)
+        if launch_rate:
+            self.launch_slots = LaunchSlots(
+                launch_rate,
+                min_lead=timedelta(seconds=self.config['main'].get(
+                    'launch_min_lead',
+                    MIN_AUCTION_START_TIME_RESERV.total_seconds())),
+                timezone=kwargs.get('timezone'))
+        self.warm_pool = None
+        warm_pool_size = self.config['main'].get('warm_pool_size', 0)
+        if warm_pool_size:
+            self.warm_pool = WarmWorkerPool(
+                warm_pool_size,
+                preload=self.config['main'].get(
+                    'warm_pool_preload', WARM_POOL_PRELOAD),
+                python=self.config['main'].get(
+                    'warm_pool_python', sys.executable),
+                logger=logger)
 
     def _create_default_executor(self):
         return AuctionExecutor()
 
+    def node_load(self):
+        return {
+            'workers': self._count_auctions,
+            'limit_auctions': self._limit_auctions,
+            'free_memory': self.resources.free_memory,
+            'limit_free_memory': self._limit_free_memory,
+            'cpu': self.resources.cpu,
+            'processes': self.resources.processes
+        }
+
+    def on_placement(self, document_id, placement):
+        self.logger.info('Auction {} placed by {}'.format(
+            document_id, placement.get('placed_by')))
+        self.schedule_auction(document_id, placement,
+                              args=placement['args'])
+
+    def start(self, *args, **kwargs):
+        if self.use_consul:
+            self.session.start()
+        self.resources.start()
+        self.workers.start()
+        if self.warm_pool:
+            self.warm_pool.start()
+        if self.cluster:
+            self.cluster.start()
+        if self.locks and self._locks_claimer is None:
+            self._locks_claimer = spawn(self.run_locks_claimer)
+        paused = kwargs.pop('paused', False)
+        response = super(AuctionScheduler, self).start(
+            *args, paused=True, **kwargs)
+        self.reschedule_missed()
+        if not paused:
+            self.resume()
+        return response
+
+    def reschedule_missed(self):
+        """Run the persisted jobs which became due while the node was down
+        now (they would be dropped as misfired), unless their auctions
+        have started already"""
+        if not self.jobstore:
+            return
+        now = datetime.now(self.timezone)
+        for job in self.get_jobs():
+            if job.next_run_time is None or job.next_run_time >= now:
+                continue
+            if self.convert_datetime(job.kwargs['start']) - now > \
+                    MIN_AUCTION_START_TIME_RESERV:
+                self.logger.info('Run missed job of {}'.format(job.id))
+                self.modify_job(job.id, next_run_time=now)
+            else:
+                self.logger.warning('Missed start of {}'.format(job.id))
+                self.unschedule_auction(job.id)
+
+    def claim_due_locks(self):
+        """Claim locks of the auctions which start in the next lock window
+        with one Consul transaction"""
+        due = datetime.now(self.timezone) + \
+            timedelta(seconds=self.locks.window)
+        keys = []
+        for job in self.get_jobs():
+            document_id = job.id
+            if job.next_run_time is None or job.next_run_time > due or \
+                    document_id in self.active:
+                continue
+            if self.cluster:
+                node = self.cluster.placed(document_id)
+                if node is None and self.cluster.owns(document_id):
+                    kwargs = job.kwargs
+                    node = self.cluster.place(
+                        document_id,
+                        {'start': kwargs.get('start'),
+                         'args': kwargs.get('args'),
+                         'procurementMethodType':
+                            kwargs.get('auction_type', '')})
+                if node != self.server_name:
+                    continue
+            keys.append("auction_{}".format(document_id))
+        return self.locks.claim(keys, self.server_name)
+
+    def run_locks_claimer(self):
+        while not self.exit:
+            try:
+                self.claim_due_locks()
+            except Exception as e:
+                self.logger.warning(
+                    'Failed to claim auction locks: {}'.format(repr(e)))
+            sleep(self.locks.window / 2.0)
+
     def convert_datetime(self, datetime_stamp):
         return iso8601.parse_date(datetime_stamp).astimezone(self.timezone)
 
     def shutdown(self, SIGKILL=False, stop_chronograph=False):
         self.exit = True
+        if self._locks_claimer is not None:
+            self._locks_claimer.kill(block=False)
+            self._locks_claimer = None
+        for watcher in self.lock_watchers.values():
+            watcher.kill(block=False)
+        if self.cluster:
+            self.cluster.stop()
+        if self.warm_pool:
+            self.warm_pool.stop()
         if SIGKILL:
             if stop_chronograph:
                 self.chronograph.server.stop()
@@ -109,90 +374,283 @@ class AuctionScheduler(GeventScheduler):
         except SchedulerNotRunningError:
             self.logger.debug('Scheduler is not running')
             response = False
+        while self.processes:
+            sleep(1)
+        self.resources.stop()
+        self.workers.stop()
+        if self.use_consul:
+            self.session.stop()
 
         self.execution_stopped = True
         return response
 
-    def _auction_fucn(self, args):
-        process = None
+    def _auction_fucn(self, args, start='', auction_type='', on_exit=None):
+        """Start the worker, ``on_exit`` is called when the worker exits
+        (or fails to start)"""
         try:
-            process = Popen(args)
-            self.processes[process.pid] = process
-            rc = process.wait()
-            if rc == 0:
-                self.logger.info(
-                    "Finished {}".format(args[2]),
-                    extra={
-                        'MESSAGE_ID': 'CHRONOGRAPH_WORKER_COMPLETE_SUCCESSFUL'
-                    }
-                )
+            if self.warm_pool:
+                process = self.warm_pool.run(args)
             else:
-                self.logger.error(
-                    "Exit with error {}".format(args[2]),
-                    extra={
-                        'MESSAGE_ID': 'CHRONOGRAPH_WORKER_COMPLETE_EXCEPTION'
-                    }
-                )
+                process = Popen(args)
+            self.processes[process.pid] = process
+            start_delay = None
+            if start:
+                start_delay = (datetime.now(self.timezone) -
+                               self.convert_datetime(start)).total_seconds()
+            self.workers.started(process.pid, args[2], auction_type,
+                                 start_delay)
+            self.supervisor.watch(process, self._worker_exited,
+                                  args, auction_type, on_exit)
         except Exception as error:
             self.logger.critical(
                 "Exit with error {} params: {} error: {}".format(
                     args[2], repr(args), repr(error)),
                 extra={'MESSAGE_ID': 'CHRONOGRAPH_WORKER_COMPLETE_EXCEPTION'})
-        if process:
-            del self.processes[process.pid]
+            if on_exit:
+                on_exit()
 
-    def run_auction_func(self, args, ttl=WORKER_TIME_RUN, start='',
-                         document_id=''):
-        if self._count_auctions >= self._limit_auctions:
-            self.logger.info("Limited by count")
-            return
+    def _worker_exited(self, pid, rc, args, auction_type, on_exit):
+        if rc == 0:
+            self.logger.info(
+                "Finished {}".format(args[2]),
+                extra={
+                    'MESSAGE_ID': 'CHRONOGRAPH_WORKER_COMPLETE_SUCCESSFUL'
+                }
+            )
+        else:
+            self.logger.error(
+                "Exit with error {}".format(args[2]),
+                extra={
+                    'MESSAGE_ID': 'CHRONOGRAPH_WORKER_COMPLETE_EXCEPTION'
+                }
+            )
+        record = self.workers.stopped(pid, rc)
+        if record and self.admission:
+            self.admission.observe(auction_type, record['peak_rss'])
+        self.processes.pop(pid, None)
+        if on_exit:
+            on_exit()
 
-        if free_memory() <= self._limit_free_memory:
-            self.logger.info("Limited by memory")
-            return
+    def run_auction_func(self, args, start='', document_id='',
+                         auction_type=''):
         if not document_id:
             document_id = args[2]
-        sleep(random())
-        if self.use_consul:
-            i = LOCK_RETRIES
-            session = self.consul.session.create(behavior='delete', ttl=ttl)
-            while i > 0:
-                if self.consul.kv.put("auction_{}".format(document_id),
-                                      self.server_name, acquire=session):
-                    self.logger.info(
-                        "Run worker for document {}".format(document_id),
-                        extra={'MESSAGE_ID': 'CHRONOGRAPH_RUN_WORKER'})
-                    with self._limit_pool_lock:
-                        self._count_auctions += 1
+        if self.cluster:
+            # limits of the nodes are taken into account by the placement
+            node = self.cluster.placed(document_id)
+            if node is None and self.cluster.owns(document_id):
+                node = self.cluster.place(
+                    document_id, {'start': start, 'args': args,
+                                  'procurementMethodType': auction_type})
+            if node != self.server_name:
+                if not self.owner_missed(document_id, start):
+                    # the owner runs it, take over if its session expires
+                    self.watch_lock(args, start, document_id, auction_type)
+                    return
 
-                    self._auction_fucn(args)
+        self.launch_auction(args, start, document_id, auction_type)
 
+    def launch_auction(self, args, start, document_id, auction_type):
+        key = "auction_{}".format(document_id)
+        if not self.within_limits():
+            self.drop_lock(key)
+            return
+
+        if self.admission and not self.admission.admit(
+                document_id, auction_type, self.workers.running.values(),
+                self.resources.available_memory,
+                self.resources.total_memory, self._limit_free_memory):
+            self.drop_lock(key)
+            self.defer_auction(args, start, document_id, auction_type)
+            return
+
+        claimed = lost = False
+        if self.locks:
+            claimed = self.locks.take(key)
+            # held by other node when the window was claimed
+            lost = self.locks.is_lost(key)
+        if not self.cluster and not claimed:
+            sleep(random())
+        if self.use_consul:
+            if claimed or not lost and self.acquire_lock(key):
+                self.logger.info(
+                    "Run worker for document {}".format(document_id),
+                    extra={'MESSAGE_ID': 'CHRONOGRAPH_RUN_WORKER'})
+                with self._limit_pool_lock:
+                    self._count_auctions += 1
+                self.active.add(document_id)
+
+                def on_exit():
                     self.logger.info("Finished {}".format(document_id))
-                    self.consul.session.destroy(session)
+                    self.session.release(key)
+                    if self.cluster:
+                        self.cluster.release(document_id)
                     with self._limit_pool_lock:
                         self._count_auctions -= 1
-                    return
-                sleep(SLEEP_BETWEEN_TRIES_LOCK)
-                i -= 1
+                    self.active.discard(document_id)
+
+                self._auction_fucn(args, start, auction_type, on_exit)
+                return
 
             self.logger.debug("Locked on other server")
-            self.consul.session.destroy(session)
+            self.watch_lock(args, start, document_id, auction_type)
         else:
             self.logger.info("Run worker for document {}".format(document_id),
                              extra={'MESSAGE_ID': 'CHRONOGRAPH_RUN_WORKER'})
-            self._auction_fucn(args)
+            self.active.add(document_id)
+            self._auction_fucn(args, start, auction_type,
+                               lambda: self.active.discard(document_id))
+
+    def acquire_lock(self, key):
+        """Acquire the auction lock, give up as soon as it is held by other
+        node (retry only while the key is free, e.g. in the lock-delay of
+        an invalidated session)"""
+        for _ in xrange(LOCK_RETRIES):
+            if self.session.acquire(key, self.server_name):
+                return True
+            if self.session.holder(key):
+                return False
+            sleep(SLEEP_BETWEEN_TRIES_LOCK)
+        return False
+
+    def watch_lock(self, args, start, document_id, auction_type):
+        """Take over the auction if the session of the node holding its
+        lock expires while the worker would run"""
+        if document_id in self.lock_watchers:
+            return
+        deadline = timegm(self.convert_datetime(start).utctimetuple()) \
+            if start else time()
+        self.lock_watchers[document_id] = spawn(
+            self._watch_lock, args, start, document_id, auction_type,
+            deadline + WORKER_TIME_RUN)
+
+    def _watch_lock(self, args, start, document_id, auction_type, deadline):
+        key = "auction_{}".format(document_id)
+        try:
+            expired = self.session.wait_expired(key, deadline)
+        except Exception as e:
+            self.logger.warning(
+                "Failed to watch lock of {}: {}".format(document_id, repr(e)))
+            expired = False
+        finally:
+            self.lock_watchers.pop(document_id, None)
+        if expired and not self.exit:
+            self.logger.warning(
+                "Holder of {} lock is gone, take over".format(document_id))
+            if self.locks:
+                self.locks.forget_lost(key)
+            self.launch_auction(args, start, document_id, auction_type)
+
+    def within_limits(self):
+        if self._count_auctions >= self._limit_auctions:
+            self.logger.info("Limited by count")
+            return False
+
+        if self.resources.free_memory <= self._limit_free_memory:
+            self.logger.info("Limited by memory")
+            return False
+
+        if self._limit_cpu_load and \
+                self.resources.cpu >= self._limit_cpu_load:
+            self.logger.info("Limited by CPU load")
+            return False
+
+        if self._limit_processes and \
+                self.resources.processes >= self._limit_processes:
+            self.logger.info("Limited by processes count")
+            return False
+        return True
+
+    def drop_lock(self, key):
+        """Release the lock claimed for the auction which is not run"""
+        if self.locks:
+            self.locks.drop(key)
+
+    def defer_auction(self, args, start, document_id, auction_type):
+        """Hand off the auction to other node of the cluster with free
+        capacity or retry it later if there is time before the start"""
+        if self.cluster and self.cluster.hand_off(
+                document_id, {'start': start, 'args': args,
+                              'procurementMethodType': auction_type}):
+            return
+        now = datetime.now(self.timezone)
+        min_lead = self.launch_slots.min_lead if self.launch_slots \
+            else MIN_AUCTION_START_TIME_RESERV
+        if now + self._admission_defer > \
+                self.convert_datetime(start) - min_lead:
+            self.logger.warning(
+                "Limited by predicted memory {}".format(document_id))
+            return
+        self.logger.info("Defer start of {}".format(document_id))
+        self.add_job(
+            run_auction,
+            kwargs=dict(args=args, start=start, document_id=document_id,
+                        auction_type=auction_type),
+            misfire_grace_time=60, next_run_time=now + self._admission_defer,
+            id=document_id, replace_existing=True
+        )
+
+    def owner_missed(self, document_id, start=''):
+        """Give the node the auction belongs to time to take the lock and
+        check whether it did (the node could die or leave the cluster).
+        The wait ends not later than the minimal start reserve before the
+        auction start, to leave time to run the auction here."""
+        deadline = time() + self._shard_fallback_delay
+        if start:
+            deadline = min(deadline, timegm(
+                self.convert_datetime(start).utctimetuple()) -
+                MIN_AUCTION_START_TIME_RESERV.total_seconds())
+        key = "auction_{}".format(document_id)
+        try:
+            locked = self.session.wait_locked(key, deadline)
+        except Exception as e:
+            self.logger.warning(
+                "Failed to watch lock of {}: {}".format(document_id, repr(e)))
+            locked = False
+        if locked:
+            self.logger.debug("{} is locked by other node".format(document_id))
+            return False
+        self.logger.warning(
+            "Node {} missed start of {}".format(
+                self.cluster.placed(document_id) or
+                self.cluster.owner(document_id), document_id))
+        return True
+
+    def _job_removed(self, event):
+        if event.code == EVENT_ALL_JOBS_REMOVED:
+            self.scheduled.clear()
+        else:
+            self.scheduled.pop(event.job_id, None)
+
+    def unchanged(self, document_id, view_value):
+        """Check that the auction is scheduled with the same view value"""
+        self.schedule_stats['rows'] += 1
+        if self.scheduled.get(document_id) == schedule_signature(view_value):
+            self.schedule_stats['skipped'] += 1
+            return True
+        return False
+
+    @property
+    def skip_rate(self):
+        rows = self.schedule_stats['rows']
+        return float(self.schedule_stats['skipped']) / rows if rows else 0.0
 
     def schedule_auction(self, document_id, view_value, args):
-        auction_start_date = self.convert_datetime(view_value['start'])
-        if self._executors['default']._instances.get(document_id):
+        signature = schedule_signature(view_value)
+        if self.scheduled.get(document_id) == signature or \
+                document_id in self.active or \
+                self._executors['default']._instances.get(document_id):
             return
         job = self.get_job(document_id)
         if job:
-            job_auction_start_date = job.kwargs['start']
-            if job_auction_start_date == auction_start_date:
+            # job restored from the persistent job store
+            if job.kwargs['start'] == view_value['start']:
+                self.scheduled[document_id] = signature
                 return
             self.logger.warning("Changed start date: {}".format(document_id))
 
+        auction_start_date = self.convert_datetime(view_value['start'])
+
         now = datetime.now(self.timezone)
         if auction_start_date - now > MAX_AUCTION_START_TIME_RESERV:
             AW_date = auction_start_date - MAX_AUCTION_START_TIME_RESERV
@@ -201,16 +659,37 @@ class AuctionScheduler(GeventScheduler):
             AW_date = now
         else:
             return
+        if self.launch_slots:
+            AW_date = self.launch_slots.reserve(
+                document_id, AW_date, auction_start_date)
         self.logger.info(
             'Scedule start of {} at {} ({})'.format(
                 document_id, AW_date, view_value['start']),
             extra={'MESSAGE_ID': 'CHRONOGRAPH_PLANNED_WORKER'})
 
         self.add_job(
-            self.run_auction_func,
+            run_auction,
             kwargs=dict(
-                args=args, start=view_value['start'], document_id=document_id
+                args=args, start=view_value['start'], document_id=document_id,
+                auction_type=view_value.get('procurementMethodType') or
+                view_value.get('auction_type', '')
             ),
             misfire_grace_time=60, next_run_time=AW_date, id=document_id,
             replace_existing=True
         )
+        self.scheduled[document_id] = signature
+
+    @property
+    def jobstore(self):
+        """Persistent job store or None"""
+        jobstore = self._jobstores.get('default')
+        if isinstance(jobstore, SQLiteJobStore):
+            return jobstore
+
+    def unschedule_auction(self, document_id):
+        if self.launch_slots:
+            self.launch_slots.release(document_id)
+        try:
+            self.remove_job(document_id)
+        except JobLookupError:
+            self.logger.debug('Job {} is not scheduled'.format(document_id))
@@ -24,7 +24,67 @@ def get_active_locks():
 
 @chronograph_webapp.route("/active_jobs")
 def get_active_jobs():
-    return dumps(chronograph_webapp.chronograph.scheduler._executors['default']._instances)
+    scheduler = chronograph_webapp.chronograph.scheduler
+    active_jobs = dict(scheduler._executors['default']._instances)
+    active_jobs.update((document_id, 1) for document_id in scheduler.active)
+    return dumps(active_jobs)
+
+
+@chronograph_webapp.route("/cluster")
+def get_cluster():
+    cluster = chronograph_webapp.chronograph.scheduler.cluster
+    if not cluster:
+        return dumps({})
+    return dumps({"node": cluster.server_name,
+                  "nodes": sorted(cluster.ring.nodes),
+                  "loads": cluster.loads})
+
+
+@chronograph_webapp.route("/placements")
+def get_placements():
+    cluster = chronograph_webapp.chronograph.scheduler.cluster
+    if not cluster:
+        return dumps({})
+    return dumps(dict((document_id, {"node": placement.get('node'),
+                                     "placed_by": placement.get('placed_by'),
+                                     "start": placement.get('start')})
+                      for document_id, placement
+                      in cluster.placements.items()))
+
+
+@chronograph_webapp.route("/launch_histogram")
+def get_launch_histogram():
+    launch_slots = chronograph_webapp.chronograph.scheduler.launch_slots
+    if not launch_slots:
+        return dumps([])
+    return dumps(launch_slots.histogram())
+
+
+@chronograph_webapp.route("/workers")
+def get_workers():
+    scheduler = chronograph_webapp.chronograph.scheduler
+    response = {"running": scheduler.workers.running.values(),
+                "aggregates": scheduler.workers.aggregates()}
+    if scheduler.admission:
+        response["predicted_peak_rss"] = scheduler.admission.estimates
+    return dumps(response)
+
+
+@chronograph_webapp.route("/lock_windows")
+def get_lock_windows():
+    locks = chronograph_webapp.chronograph.scheduler.locks
+    if not locks:
+        return dumps([])
+    return dumps(list(locks.windows))
+
+
+@chronograph_webapp.route("/schedule_stats")
+def get_schedule_stats():
+    scheduler = chronograph_webapp.chronograph.scheduler
+    return dumps({"rows": scheduler.schedule_stats['rows'],
+                  "skipped": scheduler.schedule_stats['skipped'],
+                  "skip_rate": scheduler.skip_rate,
+                  "scheduled": len(scheduler.scheduled)})
 
 
 @chronograph_webapp.route("/shutdown")
@@ -0,0 +1,509 @@
+from base64 import b64encode
+from bisect import bisect
+from collections import Counter, deque
+from hashlib import md5
+from json import dumps, loads
+from logging import getLogger
+from struct import unpack
+from time import time
+
+from consul.base import ClientError
+from gevent import spawn, sleep
+
+
+CLUSTER_NODES_PREFIX = 'chronograph_nodes/'
+CLUSTER_PLACEMENTS_PREFIX = 'chronograph_placements/'
+NODE_SESSION_TTL = 30
+# max time of a blocking query on a lock key, in seconds
+LOCK_WATCH_WAIT = 60
+CLUSTER_REFRESH = 10
+HASH_RING_REPLICAS = 100
+AUCTION_LOCK_PREFIX = 'auction_'
+LOCK_WINDOW = 60
+# max count of operations in a Consul transaction
+TXN_MAX_OPS = 64
+LOCK_WINDOWS_HISTORY = 100
+# tries to write a placement changed concurrently by other nodes
+PLACEMENT_RETRIES = 5
+
+
+def _hash(key):
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return unpack('<Q', md5(key).digest()[:8])[0]
+
+
+class HashRing(object):
+    """Consistent hashing of keys over nodes
+
+    >>> ring = HashRing(['node_a', 'node_b'])
+    >>> ring.owner('UA-11111') in ('node_a', 'node_b')
+    True
+    >>> HashRing(['node_a']).owner('UA-11111')
+    'node_a'
+    >>> HashRing([]).owner('UA-11111') is None
+    True
+    """
+
+    def __init__(self, nodes, replicas=HASH_RING_REPLICAS):
+        self.nodes = frozenset(nodes)
+        points = sorted(
+            (_hash('{}:{}'.format(node, i)), node)
+            for node in self.nodes for i in xrange(replicas)
+        )
+        self._keys = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def owner(self, key):
+        if not self._keys:
+            return None
+        index = bisect(self._keys, _hash(key)) % len(self._keys)
+        return self._nodes[index]
+
+
+class NodeSession(object):
+    """Consul session shared by all keys the node holds (auction locks and
+    the cluster membership key).
+
+    The session is renewed in background. If it is lost anyway, a new
+    session is created and the held keys are acquired again.
+    """
+
+    def __init__(self, consul, name, ttl=NODE_SESSION_TTL,
+                 logger=getLogger(__name__)):
+        self.consul = consul
+        self.name = name
+        self.ttl = ttl
+        self.logger = logger
+        self.id = None
+        self.locks = {}
+        self._worker = None
+
+    def create(self):
+        self.id = self.consul.session.create(
+            name=self.name, behavior='delete', ttl=self.ttl)
+        for key, value in self.locks.items():
+            if not self.consul.kv.put(key, value, acquire=self.id):
+                self.logger.warning('Lock {} is lost'.format(key))
+                del self.locks[key]
+        return self.id
+
+    def renew(self):
+        if self.id is None:
+            return self.create()
+        try:
+            self.consul.session.renew(self.id)
+        except Exception as e:
+            self.logger.warning('Session {} is lost: {}'.format(
+                self.id, repr(e)))
+            self.create()
+        return self.id
+
+    def acquire(self, key, value):
+        if self.id is None:
+            self.create()
+        if self.consul.kv.put(key, value, acquire=self.id):
+            self.locks[key] = value
+            return True
+        return False
+
+    def holder(self, key):
+        """Session holding the key (None if the key is not locked)"""
+        _, item = self.consul.kv.get(key)
+        return item.get('Session') if item else None
+
+    def wait_locked(self, key, deadline, wait=LOCK_WATCH_WAIT):
+        """Watch the key with blocking queries until some session locks it
+        (True) or the ``deadline`` timestamp passes (False)"""
+        index = None
+        while True:
+            timeout = deadline - time()
+            if timeout <= 0:
+                return False
+            index, item = self.consul.kv.get(
+                key, index=index,
+                wait='{}s'.format(int(min(wait, max(timeout, 1)))))
+            if item and item.get('Session'):
+                return True
+
+    def wait_expired(self, key, deadline, wait=LOCK_WATCH_WAIT):
+        """Watch the key held by other session with blocking queries until
+        the session expires (True) or the ``deadline`` timestamp passes.
+        The key released by its holder (not expired) gives False."""
+        index = holder = None
+        while True:
+            timeout = deadline - time()
+            if timeout <= 0:
+                return False
+            index, item = self.consul.kv.get(
+                key, index=index,
+                wait='{}s'.format(int(min(wait, max(timeout, 1)))))
+            if item and item.get('Session'):
+                holder = item['Session']
+                if holder == self.id:
+                    return False
+                continue
+            if holder is None:
+                return True
+            _, info = self.consul.session.info(holder)
+            return info is None
+
+    def release(self, key):
+        self.locks.pop(key, None)
+        try:
+            _, item = self.consul.kv.get(key)
+            if item and item.get('Session') == self.id:
+                self.consul.kv.delete(key, cas=item['ModifyIndex'])
+        except Exception as e:
+            self.logger.warning('Failed to release {}: {}'.format(
+                key, repr(e)))
+
+    def run(self):
+        while True:
+            sleep(self.ttl / 3.0)
+            try:
+                self.renew()
+            except Exception as e:
+                self.logger.warning(
+                    'Failed to renew session: {}'.format(repr(e)))
+
+    def start(self):
+        if self._worker is None:
+            self._worker = spawn(self.run)
+
+    def stop(self):
+        if self._worker is not None:
+            self._worker.kill(block=False)
+            self._worker = None
+        if self.id:
+            try:
+                self.consul.session.destroy(self.id)
+            except Exception as e:
+                self.logger.warning(
+                    'Failed to destroy session: {}'.format(repr(e)))
+            self.id = None
+            self.locks = {}
+
+
+class ClusterMembership(object):
+    """Membership of the chronograph node in the cluster.
+
+    Every node keeps the ``chronograph_nodes/<server_name>`` Consul key
+    acquired by its NodeSession, so the key disappears when the node dies.
+    Live nodes are read from the keys and auctions are sharded between
+    them with the HashRing.
+
+    The value of the key is the current load of the node (see
+    ``AuctionScheduler.node_load``). The owner of an auction places it on
+    the least loaded node ahead of start by creating the
+    ``chronograph_placements/<document_id>`` key; ``on_placement`` is
+    called for auctions placed on this node by other nodes.
+    """
+
+    def __init__(self, consul, server_name, session,
+                 refresh=CLUSTER_REFRESH, load=None, on_placement=None,
+                 logger=getLogger(__name__)):
+        self.consul = consul
+        self.server_name = server_name
+        self.session = session
+        self.refresh = refresh
+        self.load = load
+        self.on_placement = on_placement
+        self.logger = logger
+        self.key = CLUSTER_NODES_PREFIX + server_name
+        self.ring = HashRing([server_name])
+        self.loads = {}
+        self.placements = {}
+        self._worker = None
+
+    def register(self):
+        value = dumps(self.load()) if self.load else self.server_name
+        self.session.acquire(self.key, value)
+
+    def update(self):
+        _, items = self.consul.kv.get(CLUSTER_NODES_PREFIX, recurse=True)
+        nodes = {}
+        for item in items or []:
+            if not item.get('Session'):
+                continue
+            node = item['Key'][len(CLUSTER_NODES_PREFIX):]
+            try:
+                nodes[node] = loads(item.get('Value'))
+            except (TypeError, ValueError):
+                nodes[node] = None
+        nodes.setdefault(self.server_name, None)
+        self.loads = dict((node, load) for node, load in nodes.items()
+                          if isinstance(load, dict))
+        ring = HashRing(nodes)
+        if ring.nodes != self.ring.nodes:
+            self.logger.info('Cluster nodes: {}'.format(
+                ', '.join(sorted(ring.nodes))))
+            self.ring = ring
+        self.update_placements()
+
+    def update_placements(self):
+        _, items = self.consul.kv.get(CLUSTER_PLACEMENTS_PREFIX,
+                                      recurse=True)
+        placements = {}
+        for item in items or []:
+            try:
+                placements[item['Key'][len(CLUSTER_PLACEMENTS_PREFIX):]] = \
+                    loads(item.get('Value'))
+            except (TypeError, ValueError):
+                continue
+        new = [(document_id, placement)
+               for document_id, placement in placements.items()
+               if placement.get('node') == self.server_name and
+               self.placed(document_id) != self.server_name]
+        self.placements = placements
+        if self.on_placement:
+            for document_id, placement in new:
+                self.on_placement(document_id, placement)
+
+    def run(self):
+        while True:
+            sleep(self.refresh)
+            try:
+                self.register()
+                self.update()
+            except Exception as e:
+                self.logger.warning(
+                    'Cluster membership error: {}'.format(repr(e)))
+
+    def start(self):
+        if self._worker is None:
+            try:
+                self.register()
+                self.update()
+            except Exception as e:
+                self.logger.warning(
+                    'Cluster membership error: {}'.format(repr(e)))
+            self._worker = spawn(self.run)
+
+    def stop(self):
+        if self._worker is not None:
+            self._worker.kill(block=False)
+            self._worker = None
+        self.session.release(self.key)
+
+    def owner(self, document_id):
+        return self.ring.owner(document_id)
+
+    def placed(self, document_id):
+        """Node the auction is placed on, placements on the nodes which
+        left the cluster are ignored"""
+        node = self.placements.get(document_id, {}).get('node')
+        if node in self.ring.nodes:
+            return node
+
+    def owns(self, document_id):
+        return (self.placed(document_id) or self.owner(document_id)) == \
+            self.server_name
+
+    def has_capacity(self, load):
+        return load['workers'] < load['limit_auctions'] and \
+            load['free_memory'] > load['limit_free_memory']
+
+    def least_loaded(self, exclude=(), with_capacity=False):
+        nodes = dict(self.loads)
+        if self.load:
+            nodes[self.server_name] = self.load()
+        nodes = dict((node, load) for node, load in nodes.items()
+                     if node in self.ring.nodes and node not in exclude)
+        if not nodes:
+            return None if exclude else self.server_name
+        # auctions placed but not started yet are not counted by the nodes
+        placed = Counter(placement.get('node')
+                         for placement in self.placements.values())
+
+        def load(node):
+            load = dict(nodes[node])
+            load['workers'] += placed[node]
+            return load
+
+        def score(node):
+            node_load = load(node)
+            return (not self.has_capacity(node_load),
+                    float(node_load['workers']) /
+                    (node_load['limit_auctions'] or 1),
+                    node_load['cpu'], -node_load['free_memory'], node)
+        node = min(nodes, key=score)
+        if with_capacity and not self.has_capacity(load(node)):
+            return None
+        return node
+
+    def place(self, document_id, placement):
+        """Place the auction on the least loaded node unless it was placed
+        already, return the node"""
+        key = CLUSTER_PLACEMENTS_PREFIX + document_id
+        placement = dict(placement, node=self.least_loaded(),
+                         placed_by=self.server_name)
+        index = 0
+        for _ in xrange(PLACEMENT_RETRIES):
+            if self.consul.kv.put(key, dumps(placement), cas=index):
+                break
+            _, item = self.consul.kv.get(key)
+            if item is None:
+                index = 0
+                continue
+            current = loads(item.get('Value'))
+            if current.get('node') in self.ring.nodes:
+                placement = current
+                break
+            # placed on the node which left the cluster
+            index = item['ModifyIndex']
+        else:
+            self.logger.warning(
+                'Failed to place auction {} after {} tries, run it on '
+                '{}'.format(document_id, PLACEMENT_RETRIES, self.server_name))
+            return self.server_name
+        self.placements[document_id] = placement
+        self.logger.info('Auction {} placed on {}'.format(
+            document_id, placement['node']))
+        return placement['node']
+
+    def hand_off(self, document_id, placement):
+        """Move the auction to other node with free capacity,
+        return the node or None if there is no such node"""
+        node = self.least_loaded(exclude=(self.server_name,),
+                                 with_capacity=True)
+        if node is None:
+            return None
+        key = CLUSTER_PLACEMENTS_PREFIX + document_id
+        _, item = self.consul.kv.get(key)
+        placement = dict(placement, node=node, placed_by=self.server_name)
+        if not self.consul.kv.put(key, dumps(placement),
+                                  cas=item['ModifyIndex'] if item else 0):
+            self.logger.warning(
+                'Placement of auction {} changed, not handed off'.format(
+                    document_id))
+            return None
+        self.placements[document_id] = placement
+        self.logger.info('Auction {} handed off to {}'.format(
+            document_id, node))
+        return node
+
+    def release(self, document_id):
+        self.placements.pop(document_id, None)
+        try:
+            self.consul.kv.delete(CLUSTER_PLACEMENTS_PREFIX + document_id)
+        except Exception as e:
+            self.logger.warning(
+                'Failed to release placement of {}: {}'.format(
+                    document_id, repr(e)))
+
+
+class LockManager(object):
+    """Claims auction locks in batches with Consul transactions.
+
+    Locks of all auctions due in the next ``window`` seconds are claimed
+    at once (``claim``), every lock operation is acquired by the shared
+    NodeSession. Claimed locks are taken by the workers (``take``), the
+    ones not taken in two windows are released.
+    """
+
+    def __init__(self, consul, session, window=LOCK_WINDOW,
+                 logger=getLogger(__name__)):
+        self.consul = consul
+        self.session = session
+        self.window = window
+        self.logger = logger
+        self.claimed = {}
+        self.lost = {}
+        self.windows = deque(maxlen=LOCK_WINDOWS_HISTORY)
+
+    def _lock(self, keys, value):
+        """Lock keys in one transaction, the failed operations are
+        excluded and the rest are retried"""
+        won, lost = [], []
+        pending = list(keys)
+        while pending:
+            try:
+                self.consul.txn.put([
+                    {'KV': {'Verb': 'lock', 'Key': key,
+                            'Value': b64encode(value),
+                            'Session': self.session.id}}
+                    for key in pending
+                ])
+            except ClientError as e:
+                # rolled back transaction is answered with 409 and errors
+                # of the failed operations
+                code, _, body = str(e).partition(' ')
+                if code != '409':
+                    raise
+                failed = set(error['OpIndex']
+                             for error in loads(body).get('Errors') or [])
+                if not failed:
+                    raise
+            else:
+                won.extend(pending)
+                break
+            lost.extend(pending[i] for i in sorted(failed))
+            pending = [key for i, key in enumerate(pending)
+                       if i not in failed]
+        return won, lost
+
+    def claim(self, keys, value):
+        now = time()
+        self.expire(now)
+        keys = [key for key in keys if key not in self.claimed]
+        if not keys:
+            return [], []
+        if self.session.id is None:
+            self.session.create()
+        _, items = self.consul.kv.get(AUCTION_LOCK_PREFIX, recurse=True)
+        holders = dict((item['Key'], item.get('Session'))
+                       for item in items or [])
+        won, lost, free = [], [], []
+        for key in keys:
+            holder = holders.get(key)
+            if holder == self.session.id:
+                won.append(key)
+            elif holder:
+                lost.append(key)
+            else:
+                free.append(key)
+        for i in xrange(0, len(free), TXN_MAX_OPS):
+            chunk_won, chunk_lost = self._lock(free[i:i + TXN_MAX_OPS],
+                                               value)
+            won.extend(chunk_won)
+            lost.extend(chunk_lost)
+        for key in won:
+            self.claimed[key] = now
+            self.session.locks[key] = value
+        for key in lost:
+            self.lost[key] = now
+        self.windows.append({'time': now, 'won': len(won),
+                             'lost': len(lost)})
+        self.logger.info(
+            'Auction locks claimed: {} won, {} lost'.format(
+                len(won), len(lost)),
+            extra={'MESSAGE_ID': 'CHRONOGRAPH_LOCKS_CLAIMED'})
+        return won, lost
+
+    def take(self, key):
+        """Check that the lock was claimed (and is still held) and pass
+        it to the worker"""
+        return self.claimed.pop(key, None) is not None and \
+            key in self.session.locks
+
+    def is_lost(self, key):
+        return key in self.lost
+
+    def forget_lost(self, key):
+        """The lock lost in the window is free again"""
+        self.lost.pop(key, None)
+
+    def drop(self, key):
+        """Release the claimed lock which will not be used"""
+        if self.claimed.pop(key, None) is not None:
+            self.session.release(key)
+
+    def expire(self, now):
+        for key, claimed_at in self.claimed.items():
+            if now - claimed_at > 2 * self.window:
+                self.logger.warning('Lock {} is not used'.format(key))
+                self.drop(key)
+        for key, lost_at in self.lost.items():
+            if now - lost_at > 2 * self.window:
+                del self.lost[key]
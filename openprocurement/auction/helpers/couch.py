@@ -27,7 +27,7 @@ def couchdb_dns_query_settings(server_url, database_name):
     raise Exception("No route to any couchdb server")
 
 
-def iterview(server_url, database_name, view_name, sleep_seconds=10, wrapper=None, **options):
+def iterview(server_url, database_name, view_name, sleep_seconds=10, wrapper=None, start_key=0, **options):
     """Iterate the rows in a view, fetching rows in batches and yielding
     one row at a time.
 
@@ -42,11 +42,11 @@ def iterview(server_url, database_name, view_name, sleep_seconds=10, wrapper=Non
     :param batch: number of rows to fetch per HTTP request.
     :param wrapper: an optional callable that should be used to wrap the
                     result rows
+    :param start_key: key to start the iteration from
     :param options: optional query string parameters
     :return: row generator
     """
     database = couchdb_dns_query_settings(server_url, database_name)
-    start_key = 0
     options['start_key'] = start_key
     options['limit'] = 1000
     design_timeout = 2  # start timeout for view waiting
@@ -76,3 +76,55 @@ def iterview(server_url, database_name, view_name, sleep_seconds=10, wrapper=Non
         else:
             sleep(sleep_seconds)
         options['start_key'] = (start_key + 1)
+
+
+def iterchanges(server_url, database_name, filter_name, since=0,
+                heartbeat=10000, sleep_seconds=1, **options):
+    """Iterate the continuous ``_changes`` feed of the database, yielding
+    one change (with the document included) at a time.
+
+    The feed is reconnected on errors and resumed from the last seen
+    sequence, so every document change is yielded at least once.
+
+    :param filter_name: the name of the filter function, in the format
+                        ``design_docid/filtername``
+    :param since: sequence to start the feed from
+    :param heartbeat: period in milliseconds after which an empty line
+                      is sent by the server to keep the connection open
+    :param options: optional query string parameters
+    :return: change generator
+    """
+    database = couchdb_dns_query_settings(server_url, database_name)
+    design_timeout = 2  # start timeout for filter waiting
+    while TRUE:
+        try:
+            for change in database.changes(feed='continuous',
+                                           filter=filter_name,
+                                           since=since,
+                                           include_docs=True,
+                                           heartbeat=heartbeat,
+                                           **options):
+                if 'last_seq' in change:
+                    # feed was closed by the server
+                    since = change['last_seq']
+                    break
+                since = change['seq']
+                if change.get('deleted'):
+                    continue
+                yield change
+                if not TRUE:
+                    return
+        except socket.error:
+            database = couchdb_dns_query_settings(server_url, database_name)
+            continue
+        except ResourceNotFound as e:
+            if design_timeout > 16:
+                LOGGER.error('Iterchanges couch error: {}'.format(repr(e)))
+                raise e
+            LOGGER.warning('Missing filter document, waiting...')
+            sleep(design_timeout)
+            design_timeout *= 2
+            continue
+        except Exception as e:
+            LOGGER.warning('Couch changes feed error: {}'.format(repr(e)))
+        sleep(sleep_seconds)
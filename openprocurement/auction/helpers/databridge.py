@@ -0,0 +1,444 @@
+import iso8601
+
+from collections import deque, OrderedDict
+from hashlib import md5, sha1
+from json import dumps
+from logging import getLogger
+from math import ceil, exp, log
+from struct import unpack
+from time import time
+
+from gevent import spawn, sleep
+from gevent.pool import Pool
+from openprocurement_client.sync import ResourceFeeder
+
+from openprocurement.auction.design import startDate_view, endDate_view
+from openprocurement.auction.utils import timestamp_key
+from openprocurement.auction.systemd_msgs_ids import\
+    DATA_BRIDGE_PLANNING_POOL_STATS, DATA_BRIDGE_PLANNING_CACHE_STATS
+
+
+PLANNING_CONCURRENCY = 10
+PLANNING_STATS_INTERVAL = 60
+CHANGES_HEARTBEAT = 10000
+CHANGES_RETRY_SLEEP = 1
+CHECKPOINT_INTERVAL = 100
+CHECKPOINT_DOC_ID = '_local/feed_checkpoint_{}'
+RE_PLANNING_RATE = 10
+RE_PLANNING_CAPACITY = 1000000
+RE_PLANNING_ERROR_RATE = 0.001
+RE_PLANNING_PROGRESS_INTERVAL = 60
+# seconds between checks that the re-planning feed is done
+RE_PLANNING_DONE_CHECK = 1
+FEED_CACHE_SIZE = 100000
+AUCTIONS_INDEX_PRUNE_INTERVAL = 60 * 60
+
+
+class PlanningPool(object):
+    """Bounded pool of planning workers.
+
+    Commands are queued per tender, so commands for the same tender
+    are executed one by one in the order they were added, while commands
+    for different tenders run concurrently (up to ``size`` at once).
+    ``add`` blocks while every worker is busy, which throttles the feed.
+    """
+
+    def __init__(self, size=PLANNING_CONCURRENCY,
+                 stats_interval=PLANNING_STATS_INTERVAL,
+                 logger=getLogger(__name__)):
+        self.size = size
+        self.stats_interval = stats_interval
+        self.logger = logger
+        self._pool = Pool(size)
+        self._queues = {}
+        self._unfinished = set()
+        self.queued = 0
+        self.processed = 0
+        self._started_at = self._reported_at = time()
+
+    @property
+    def depth(self):
+        return self.queued - self.processed
+
+    @property
+    def throughput(self):
+        elapsed = time() - self._started_at
+        return self.processed / elapsed if elapsed > 0 else 0.0
+
+    def add(self, tender_id, func, *args, **kwargs):
+        seq = self.queued
+        self.queued += 1
+        self._unfinished.add(seq)
+        if tender_id in self._queues:
+            self._queues[tender_id].append((seq, func, args, kwargs))
+            return
+        self._queues[tender_id] = deque([(seq, func, args, kwargs)])
+        self._pool.spawn(self._drain, tender_id)
+
+    def done_before(self, seq):
+        """Check that every command added before the ``seq``-th one
+        has been executed"""
+        return not any(s < seq for s in self._unfinished)
+
+    def _drain(self, tender_id):
+        queue = self._queues[tender_id]
+        try:
+            while queue:
+                seq, func, args, kwargs = queue.popleft()
+                try:
+                    func(*args, **kwargs)
+                except Exception as e:
+                    self.logger.error(
+                        'Planning of tender {} failed: {}'.format(
+                            tender_id, repr(e)))
+                self._unfinished.discard(seq)
+                self.processed += 1
+                self.report()
+        finally:
+            del self._queues[tender_id]
+
+    def report(self, force=False):
+        now = time()
+        if not force and now - self._reported_at < self.stats_interval:
+            return
+        self._reported_at = now
+        self.logger.info(
+            'Planning pool: {} queued, {} processed, {} running, '
+            '{:.2f} commands/s'.format(
+                self.depth, self.processed, len(self._pool),
+                self.throughput),
+            extra={'MESSAGE_ID': DATA_BRIDGE_PLANNING_POOL_STATS})
+
+    def join(self, timeout=None):
+        return self._pool.join(timeout=timeout)
+
+
+class AuctionsIndex(object):
+    """In-memory index of auctions stored in the auctions database.
+
+    Maps auction id to the start and the end timestamps of the auction
+    (the same keys as in ``auctions/by_startDate`` and ``auctions/by_endDate``
+    views). The index is loaded from the views once and then kept up to date
+    from the ``_changes`` feed.
+
+    Only auctions starting in the future are kept in ``start`` (auctions with
+    past start dates are not planned) and only auctions ending in the future
+    in ``end`` (only they are cancelled), the past ones are pruned every
+    ``prune_interval`` seconds.
+    """
+
+    def __init__(self, db, prune_interval=AUCTIONS_INDEX_PRUNE_INTERVAL,
+                 logger=getLogger(__name__)):
+        self.db = db
+        self.prune_interval = prune_interval
+        self.logger = logger
+        self.start = {}
+        self.end = {}
+        self.since = 0
+        self.pruned_at = time()
+        self._follower = None
+
+    def build(self):
+        self.since = self.db.info()['update_seq']
+        self.pruned_at = time()
+        self.start = dict(
+            (row.id, row.key)
+            for row in startDate_view(self.db, startkey=self.pruned_at * 1000))
+        self.end = dict(
+            (row.id, row.key)
+            for row in endDate_view(self.db, startkey=self.pruned_at * 1000))
+        self.logger.info('Auctions index loaded: {} auctions'.format(
+            len(self.start)))
+
+    def update(self, doc):
+        doc_id = doc['_id']
+        if doc_id.startswith('_design/'):
+            return
+        if doc.get('_deleted'):
+            self.start.pop(doc_id, None)
+            self.end.pop(doc_id, None)
+            return
+        try:
+            start = timestamp_key(
+                iso8601.parse_date(doc['stages'][0]['start']))
+        except (KeyError, IndexError, TypeError, iso8601.ParseError):
+            start = None
+        if start is not None and start >= time() * 1000:
+            self.start[doc_id] = start
+        else:
+            self.start.pop(doc_id, None)
+        try:
+            end = timestamp_key(iso8601.parse_date(
+                doc.get('endDate') or doc['stages'][0]['start']))
+        except (KeyError, IndexError, TypeError, iso8601.ParseError):
+            end = None
+        if end is not None and end >= time() * 1000:
+            self.end[doc_id] = end
+        else:
+            self.end.pop(doc_id, None)
+
+    def follow(self):
+        while True:
+            try:
+                for change in self.db.changes(feed='continuous',
+                                              since=self.since,
+                                              include_docs=True,
+                                              heartbeat=CHANGES_HEARTBEAT):
+                    if 'id' not in change:
+                        continue
+                    doc = change.get('doc') or {'_id': change['id']}
+                    if change.get('deleted'):
+                        doc['_deleted'] = True
+                    self.update(doc)
+                    self.since = change['seq']
+                    if time() - self.pruned_at >= self.prune_interval:
+                        self.prune()
+            except Exception as e:
+                self.logger.warning(
+                    'Auctions index changes feed error: {}'.format(repr(e)))
+            sleep(CHANGES_RETRY_SLEEP)
+
+    def prune(self):
+        """Forget auctions which started and ended already"""
+        self.pruned_at = time()
+        now = self.pruned_at * 1000
+        self.start = dict((auction_id, start)
+                          for auction_id, start in self.start.items()
+                          if start >= now)
+        self.end = dict((auction_id, end)
+                        for auction_id, end in self.end.items()
+                        if end >= now)
+
+    def start_following(self):
+        if self._follower is None:
+            self._follower = spawn(self.follow)
+
+    def stop_following(self):
+        if self._follower is not None:
+            self._follower.kill(block=False)
+            self._follower = None
+
+    def is_planned(self, auction_id, start_date):
+        return self.start.get(auction_id) == timestamp_key(start_date)
+
+    def is_scheduled(self, auction_id, now=None):
+        """Check that the auction ends (or starts, if it has no end date
+        yet) in the future"""
+        if now is None:
+            now = time() * 1000
+        return self.end.get(auction_id, 0) > now
+
+
+class FeedCheckpoint(object):
+    """Feed offsets of the data bridge stored in a CouchDB ``_local``
+    document (``_local`` documents are not replicated)"""
+
+    def __init__(self, db, resource, logger=getLogger(__name__)):
+        self.db = db
+        self.doc_id = CHECKPOINT_DOC_ID.format(resource)
+        self.logger = logger
+
+    def load(self):
+        doc = self.db.get(self.doc_id)
+        if doc and doc.get('forward'):
+            return {'forward': doc['forward'],
+                    'backward': doc.get('backward')}
+
+    def save(self, offsets):
+        doc = self.db.get(self.doc_id) or {'_id': self.doc_id}
+        doc.update(offsets)
+        try:
+            self.db.save(doc)
+        except Exception as e:
+            self.logger.warning(
+                'Failed to save feed checkpoint: {}'.format(repr(e)))
+
+    def clear(self):
+        doc = self.db.get(self.doc_id)
+        if doc:
+            self.db.delete(doc)
+
+
+class CheckpointResourceFeeder(ResourceFeeder):
+    """ResourceFeeder which resumes the feed from saved offsets
+    (see FeedCheckpoint) instead of a full resync.
+
+    Relies on ResourceFeeder internals of openprocurement_client 2.0
+    (pinned in setup.py): init_api_clients, forward_client and
+    backward_client, forward_params and backward_params, cookies,
+    retriever_forward and retriever_backward, forward_worker and
+    backward_worker.
+    """
+
+    checkpoint = None
+    # requests session shared with the bridge (see IAuctionPlanner)
+    session = None
+
+    def init_api_clients(self):
+        super(CheckpointResourceFeeder, self).init_api_clients()
+        if self.session is None:
+            return
+        self.session.auth = self.forward_client.session.auth
+        self.session.headers.update(self.forward_client.session.headers)
+        self.forward_client.session = self.backward_client.session = \
+            self.session
+        self.cookies = self.session.cookies
+
+    def start_sync(self):
+        if not self.checkpoint:
+            return super(CheckpointResourceFeeder, self).start_sync()
+        self.init_api_clients()
+        self.forward_params['offset'] = self.checkpoint['forward']
+        if self.checkpoint.get('backward'):
+            self.backward_params['offset'] = self.checkpoint['backward']
+            self.backward_worker = spawn(self.retriever_backward)
+        else:
+            # backward sync was completed before the checkpoint
+            self.backward_worker = spawn(lambda: 0)
+        self.forward_worker = spawn(self.retriever_forward)
+
+    @property
+    def backward_done(self):
+        backward_worker = getattr(self, 'backward_worker', None)
+        return backward_worker is not None and \
+            backward_worker.ready() and backward_worker.value == 0
+
+    @property
+    def offsets(self):
+        return {
+            'forward': getattr(self, 'forward_params', {}).get('offset'),
+            'backward': None if self.backward_done
+            else getattr(self, 'backward_params', {}).get('offset')
+        }
+
+
+class BloomFilter(object):
+    """Set of strings with bounded memory usage and ``error_rate``
+    probability of false positives
+
+    >>> seen = BloomFilter(capacity=1000)
+    >>> seen.add('UA-11111')
+    >>> 'UA-11111' in seen, 'UA-22222' in seen
+    (True, False)
+    >>> len(seen)
+    1
+    """
+
+    def __init__(self, capacity=RE_PLANNING_CAPACITY,
+                 error_rate=RE_PLANNING_ERROR_RATE):
+        self.capacity = capacity
+        self.size = int(ceil(-capacity * log(error_rate) / log(2) ** 2))
+        self.hashes = max(1, int(round(self.size * log(2) / capacity)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        h1, h2 = unpack('<QQ', md5(key).digest())
+        for i in xrange(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, key):
+        added = False
+        for position in self._positions(key):
+            byte, bit = divmod(position, 8)
+            if not self.bits[byte] & (1 << bit):
+                self.bits[byte] |= 1 << bit
+                added = True
+        if added:
+            self.count += 1
+
+    def __contains__(self, key):
+        for position in self._positions(key):
+            byte, bit = divmod(position, 8)
+            if not self.bits[byte] & (1 << bit):
+                return False
+        return True
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def false_positive_rate(self):
+        """Probability of a false positive with the keys added so far"""
+        return (1 - exp(-float(self.hashes) * self.count / self.size)) ** \
+            self.hashes
+
+
+class RateLimiter(object):
+    """Allows at most ``rate`` calls of ``wait`` per second
+    (no limit if ``rate`` is 0)"""
+
+    def __init__(self, rate=RE_PLANNING_RATE):
+        self.interval = 1.0 / rate if rate else 0
+        self._next = 0
+
+    def wait(self):
+        now = time()
+        if self._next > now:
+            sleep(self._next - now)
+            now = self._next
+        self._next = now + self.interval
+
+
+class FeedItemsCache(object):
+    """LRU cache of feed items keyed by tender id.
+
+    Keeps a hash of the fields planning depends on, so feed items which
+    were already seen with the same values are not planned again.
+    """
+
+    def __init__(self, fields, size=FEED_CACHE_SIZE,
+                 stats_interval=PLANNING_STATS_INTERVAL,
+                 logger=getLogger(__name__)):
+        self.fields = fields
+        self.size = size
+        self.stats_interval = stats_interval
+        self.logger = logger
+        self._items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._reported_at = time()
+
+    def digest(self, item):
+        return sha1(dumps([item.get(field) for field in self.fields],
+                          sort_keys=True)).hexdigest()
+
+    def changed(self, item):
+        """Check whether planning fields of the item changed since it was
+        planned last time"""
+        item_id = item.get('id')
+        if not item_id:
+            return True
+        cached = self._items.pop(item_id, None)
+        if cached is not None:
+            self._items[item_id] = cached
+        if cached == self.digest(item):
+            self.hits += 1
+            changed = False
+        else:
+            self.misses += 1
+            changed = True
+        self.report()
+        return changed
+
+    def remember(self, item):
+        """Remember planning fields of the successfully planned item"""
+        item_id = item.get('id')
+        if not item_id:
+            return
+        self._items.pop(item_id, None)
+        self._items[item_id] = self.digest(item)
+        if len(self._items) > self.size:
+            self._items.popitem(last=False)
+
+    def report(self, force=False):
+        now = time()
+        if not force and now - self._reported_at < self.stats_interval:
+            return
+        self._reported_at = now
+        self.logger.info(
+            'Feed items cache: {} hits, {} misses, {} items'.format(
+                self.hits, self.misses, len(self._items)),
+            extra={'MESSAGE_ID': DATA_BRIDGE_PLANNING_CACHE_STATS})
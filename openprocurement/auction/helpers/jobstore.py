@@ -0,0 +1,126 @@
+import cPickle as pickle
+import sqlite3
+
+from apscheduler.job import Job
+from apscheduler.jobstores.base import (
+    BaseJobStore, ConflictingIdError, JobLookupError
+)
+from apscheduler.util import (
+    datetime_to_utc_timestamp, utc_timestamp_to_datetime
+)
+
+
+class SQLiteJobStore(BaseJobStore):
+    """Stores jobs in a local SQLite database, so the scheduler gets its
+    jobs back after a restart.
+
+    Besides the jobs, the database keeps named values (``get_meta`` and
+    ``set_meta``), e.g. position of the feed the jobs were built from.
+    """
+
+    def __init__(self, path, pickle_protocol=pickle.HIGHEST_PROTOCOL):
+        super(SQLiteJobStore, self).__init__()
+        self.path = path
+        self.pickle_protocol = pickle_protocol
+        self.connection = sqlite3.connect(path, isolation_level=None)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            'id TEXT PRIMARY KEY, next_run_time REAL, job_state BLOB)')
+        self.connection.execute(
+            'CREATE INDEX IF NOT EXISTS jobs_next_run_time '
+            'ON jobs (next_run_time)')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value)')
+
+    def get_meta(self, name, default=None):
+        row = self.connection.execute(
+            'SELECT value FROM meta WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, name, value):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)',
+            (name, value))
+
+    def lookup_job(self, job_id):
+        row = self.connection.execute(
+            'SELECT job_state FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return self._reconstitute_job(row[0]) if row else None
+
+    def get_due_jobs(self, now):
+        return self._get_jobs(
+            'WHERE next_run_time <= ?', (datetime_to_utc_timestamp(now),))
+
+    def get_next_run_time(self):
+        row = self.connection.execute(
+            'SELECT next_run_time FROM jobs WHERE next_run_time IS NOT NULL '
+            'ORDER BY next_run_time LIMIT 1').fetchone()
+        return utc_timestamp_to_datetime(row[0]) if row else None
+
+    def get_all_jobs(self):
+        jobs = self._get_jobs()
+        self._fix_paused_jobs_sorting(jobs)
+        return jobs
+
+    def add_job(self, job):
+        try:
+            self.connection.execute(
+                'INSERT INTO jobs (id, next_run_time, job_state) '
+                'VALUES (?, ?, ?)',
+                (job.id, datetime_to_utc_timestamp(job.next_run_time),
+                 self._dump(job)))
+        except sqlite3.IntegrityError:
+            raise ConflictingIdError(job.id)
+
+    def update_job(self, job):
+        cursor = self.connection.execute(
+            'UPDATE jobs SET next_run_time = ?, job_state = ? WHERE id = ?',
+            (datetime_to_utc_timestamp(job.next_run_time), self._dump(job),
+             job.id))
+        if cursor.rowcount == 0:
+            raise JobLookupError(job.id)
+
+    def remove_job(self, job_id):
+        cursor = self.connection.execute(
+            'DELETE FROM jobs WHERE id = ?', (job_id,))
+        if cursor.rowcount == 0:
+            raise JobLookupError(job_id)
+
+    def remove_all_jobs(self):
+        self.connection.execute('DELETE FROM jobs')
+
+    def shutdown(self):
+        self.connection.close()
+
+    def _dump(self, job):
+        return sqlite3.Binary(
+            pickle.dumps(job.__getstate__(), self.pickle_protocol))
+
+    def _reconstitute_job(self, job_state):
+        job_state = pickle.loads(str(job_state))
+        job_state['jobstore'] = self
+        job = Job.__new__(Job)
+        job.__setstate__(job_state)
+        job._scheduler = self._scheduler
+        job._jobstore_alias = self._alias
+        return job
+
+    def _get_jobs(self, condition='', params=()):
+        jobs = []
+        failed_job_ids = []
+        for job_id, job_state in self.connection.execute(
+                'SELECT id, job_state FROM jobs {} '
+                'ORDER BY next_run_time'.format(condition), params):
+            try:
+                jobs.append(self._reconstitute_job(job_state))
+            except BaseException:
+                self._logger.exception(
+                    'Unable to restore job "%s" -- removing it', job_id)
+                failed_job_ids.append(job_id)
+        for job_id in failed_job_ids:
+            self.connection.execute('DELETE FROM jobs WHERE id = ?',
+                                    (job_id,))
+        return jobs
+
+    def __repr__(self):
+        return '<%s (path=%s)>' % (self.__class__.__name__, self.path)
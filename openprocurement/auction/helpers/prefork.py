@@ -0,0 +1,110 @@
+import json
+import runpy
+import sys
+from collections import deque
+from importlib import import_module
+from logging import getLogger
+
+from gevent import spawn
+from gevent.subprocess import Popen, PIPE
+
+
+WARM_POOL_PRELOAD = ['openprocurement.auction.worker.auction']
+
+
+class WarmWorkerPool(object):
+    """Pool of idle auction worker processes.
+
+    Every process of the pool starts the python interpreter and imports
+    the ``preload`` modules in advance, then waits for the worker command
+    line (json encoded list) on stdin and runs the worker script with it.
+    """
+
+    def __init__(self, size, preload=WARM_POOL_PRELOAD,
+                 python=sys.executable, logger=getLogger(__name__)):
+        self.size = size
+        self.preload = list(preload)
+        self.python = python
+        self.logger = logger
+        self.idle = deque()
+        self.hits = 0
+        self.misses = 0
+        self._filler = None
+
+    def _spawn(self):
+        return Popen(
+            [self.python, '-m', __name__] + self.preload, stdin=PIPE
+        )
+
+    def fill(self):
+        while len(self.idle) < self.size:
+            try:
+                self.idle.append(self._spawn())
+            except Exception as e:
+                self.logger.error(
+                    'Failed to start warm worker: {}'.format(repr(e)))
+                break
+        self._filler = None
+
+    def start(self):
+        if self._filler is None:
+            self._filler = spawn(self.fill)
+
+    def take(self):
+        while self.idle:
+            process = self.idle.popleft()
+            if process.poll() is None:
+                return process
+            self.logger.warning(
+                'Warm worker {} exited with {}'.format(
+                    process.pid, process.returncode))
+
+    def run(self, args):
+        """Run the worker with ``args`` in an idle warm process
+        (or in a new one if there are no idle processes)"""
+        process = self.take()
+        self.start()
+        if process is None:
+            self.misses += 1
+            return Popen(args)
+        try:
+            process.stdin.write(json.dumps(args) + '\n')
+            process.stdin.close()
+        except (IOError, OSError) as e:
+            self.logger.warning(
+                'Warm worker {} is broken: {}'.format(process.pid, repr(e)))
+            process.kill()
+            self.misses += 1
+            return Popen(args)
+        self.hits += 1
+        return process
+
+    def stop(self):
+        if self._filler is not None:
+            self._filler.kill()
+            self._filler = None
+        while self.idle:
+            process = self.idle.popleft()
+            # worker exits without running anything on empty input
+            try:
+                process.stdin.close()
+            except (IOError, OSError):
+                process.kill()
+
+
+def main():
+    for module in sys.argv[1:]:
+        try:
+            import_module(module)
+        except ImportError as e:
+            sys.stderr.write('Failed to preload {}: {}\n'.format(
+                module, repr(e)))
+    line = sys.stdin.readline()
+    if not line.strip():
+        return
+    sys.argv = [arg.encode('utf-8') for arg in json.loads(line)]
+    runpy.run_path(sys.argv[0], run_name='__main__')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,166 @@
+import os
+from logging import getLogger
+from multiprocessing import cpu_count
 from socket import gethostname, gethostbyname
+from time import time
+from gevent import spawn, sleep
 from gevent.pywsgi import WSGIServer
 from gevent.baseserver import parse_address
 
+CGROUP_ROOT = '/sys/fs/cgroup'
+RESOURCE_MONITOR_INTERVAL = 1
 
-def free_memory():
+
+def host_memory():
     """
-    Get memory usage
+    Get available and total host memory in kB (swap is not counted)
     """
+    ret = {}
     with open('/proc/meminfo', 'r') as mem:
-        ret = {'free': 0.0, 'total': 0.0}
-
         for i in mem:
             sline = i.split()
-            if str(sline[0]) in ('MemTotal:', 'SwapTotal:'):
-                ret['total'] += int(sline[1])
-            elif str(sline[0]) in ('MemAvailable:', 'SwapFree:'):
-                ret['free'] += int(sline[1])
-    return float(ret['free']) / ret['total']
+            if sline[0] in ('MemTotal:', 'MemAvailable:'):
+                ret[sline[0]] = int(sline[1])
+                if len(ret) == 2:
+                    break
+    return ret['MemAvailable:'], ret['MemTotal:']
+
+
+def _read_int(path):
+    with open(path) as f:
+        value = f.read().strip()
+    return None if value == 'max' else int(value)
+
+
+def _inactive_file(path):
+    with open(path) as f:
+        for line in f:
+            name, value = line.split()
+            if name in ('inactive_file', 'total_inactive_file'):
+                return int(value)
+    return 0
+
+
+def cgroup_memory_files(root=CGROUP_ROOT):
+    """
+    Find memory limit, usage and stat files of the process cgroup
+    (v2 or v1), return None if there are no cgroup memory controller
+    """
+    try:
+        with open('/proc/self/cgroup') as cgroups:
+            lines = [line.strip().split(':', 2) for line in cgroups]
+    except IOError:
+        return None
+    for hierarchy, controllers, path in lines:
+        if hierarchy == '0' and not controllers:
+            files = ('memory.max', 'memory.current', 'memory.stat')
+            base = root
+        elif 'memory' in controllers.split(','):
+            files = ('memory.limit_in_bytes', 'memory.usage_in_bytes',
+                     'memory.stat')
+            base = os.path.join(root, 'memory')
+        else:
+            continue
+        # the cgroup path is not visible inside of the container namespace
+        for directory in (os.path.join(base, path.lstrip('/')), base):
+            paths = [os.path.join(directory, name) for name in files]
+            if all(os.path.isfile(p) for p in paths):
+                return paths
+    return None
+
+
+def cgroup_memory(files):
+    """
+    Get available and limit of the cgroup memory in kB, None if there is
+    no limit
+    """
+    limit_path, usage_path, stat_path = files
+    limit = _read_int(limit_path)
+    # v1 reports "no limit" as a huge number
+    if not limit or limit >= 1 << 60:
+        return None
+    usage = _read_int(usage_path) - _inactive_file(stat_path)
+    return max(0, limit - usage) // 1024, limit // 1024
+
+
+def memory(cgroup_files=None):
+    """
+    Get available and total memory in kB, taking cgroup limits into account
+    """
+    available, total = host_memory()
+    if cgroup_files:
+        cgroup = cgroup_memory(cgroup_files)
+        if cgroup is not None and \
+                float(cgroup[0]) / cgroup[1] < float(available) / total:
+            available, total = cgroup
+    return available, total
+
+
+def free_memory(cgroup_files=None):
+    """
+    Get available part of memory, taking cgroup limits into account
+    """
+    available, total = memory(cgroup_files)
+    return float(available) / total
+
+
+def processes_count():
+    """
+    Get count of the processes on the host
+    """
+    with open('/proc/loadavg') as loadavg:
+        return int(loadavg.read().split()[3].split('/')[1])
+
+
+def cpu_load():
+    """
+    Get load average for the last minute per CPU
+    """
+    return os.getloadavg()[0] / cpu_count()
+
+
+class ResourceMonitor(object):
+    """
+    Samples free memory, CPU load and processes count every ``interval``
+    seconds and serves the cached values
+    """
+
+    def __init__(self, interval=RESOURCE_MONITOR_INTERVAL,
+                 logger=getLogger(__name__)):
+        self.interval = interval
+        self.logger = logger
+        self.cgroup_files = cgroup_memory_files()
+        self._worker = None
+        self.sample()
+
+    def sample(self):
+        try:
+            self.available_memory, self.total_memory = \
+                memory(self.cgroup_files)
+            self.free_memory = \
+                float(self.available_memory) / self.total_memory
+            self.cpu = cpu_load()
+            self.processes = processes_count()
+            self.sampled_at = time()
+        except Exception as e:
+            self.logger.warning(
+                'Failed to sample resources: {}'.format(repr(e)))
+            if not hasattr(self, 'sampled_at'):
+                raise
+
+    def run(self):
+        while True:
+            sleep(self.interval)
+            self.sample()
+
+    def start(self):
+        if self._worker is None:
+            self._worker = spawn(self.run)
+
+    def stop(self):
+        if self._worker is not None:
+            self._worker.kill(block=False)
+            self._worker = None
 
 
 def get_ip_address():
@@ -0,0 +1,235 @@
+import os
+from collections import deque
+from logging import getLogger
+from time import time
+
+from gevent import spawn, sleep
+
+
+WORKERS_SAMPLE_INTERVAL = 5
+WORKERS_HISTORY_SIZE = 1000
+ADMISSION_EWMA_ALPHA = 0.3
+ADMISSION_DEFAULT_RSS = 150 * 1024
+ADMISSION_DEFER = 10
+ADMISSION_RESERVATION_TTL = 5
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+
+def sample_process(pid):
+    """
+    Get RSS, peak RSS (in kB) and CPU time (in seconds) of the process,
+    None if the process is gone
+    """
+    try:
+        with open('/proc/{}/status'.format(pid)) as status:
+            memory = dict(
+                line.split()[:2] for line in status
+                if line.startswith(('VmRSS:', 'VmHWM:'))
+            )
+        with open('/proc/{}/stat'.format(pid)) as stat:
+            # the command name may contain spaces, fields follow it
+            fields = stat.read().rsplit(')', 1)[1].split()
+    except (IOError, OSError):
+        return None
+    return {
+        'rss': int(memory.get('VmRSS:', 0)),
+        'peak_rss': int(memory.get('VmHWM:', 0)),
+        'cpu': float(int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    }
+
+
+class ChildSupervisor(object):
+    """Watches exits of child processes started with gevent's ``Popen``
+    (the child is reaped by the event loop), so no greenlet is blocked
+    while a child runs.
+
+    ``callback(pid, returncode, *args)`` is called in a new greenlet when
+    the child exits, right away if it has exited already.
+    """
+
+    def __init__(self, logger=getLogger(__name__)):
+        self.logger = logger
+        self.watchers = {}
+
+    def watch(self, process, callback, *args):
+        self.watchers[process.pid] = process
+        process.result.rawlink(
+            lambda result: self._reap(process, callback, args))
+
+    def _reap(self, process, callback, args):
+        self.watchers.pop(process.pid, None)
+        spawn(self._dispatch, callback, process.pid, process.returncode,
+              args)
+
+    def _dispatch(self, callback, pid, returncode, args):
+        try:
+            callback(pid, returncode, *args)
+        except Exception as e:
+            self.logger.error(
+                'Exit callback of {} failed: {}'.format(pid, repr(e)))
+
+    def __len__(self):
+        return len(self.watchers)
+
+
+def _summary(values):
+    if not values:
+        return None
+    return {'avg': float(sum(values)) / len(values), 'max': max(values)}
+
+
+class WorkerAccounting(object):
+    """Accounting of resources used by auction workers.
+
+    Running workers are sampled from ``/proc/<pid>`` every
+    ``sample_interval`` seconds; the last ``history_size`` finished
+    workers are kept for the aggregates.
+    """
+
+    def __init__(self, sample_interval=WORKERS_SAMPLE_INTERVAL,
+                 history_size=WORKERS_HISTORY_SIZE,
+                 logger=getLogger(__name__)):
+        self.sample_interval = sample_interval
+        self.logger = logger
+        self.running = {}
+        self.finished = deque(maxlen=history_size)
+        self._worker = None
+
+    def started(self, pid, document_id, auction_type, start_delay=None):
+        """Register the worker, ``start_delay`` is the time from the
+        auction start to the worker spawn, in seconds"""
+        self.running[pid] = {
+            'pid': pid,
+            'document_id': document_id,
+            'auction_type': auction_type,
+            'start_delay': start_delay,
+            'started_at': time(),
+            'rss': 0, 'peak_rss': 0, 'cpu': 0.0,
+        }
+        self.sample(pid)
+
+    def sample(self, pid):
+        record = self.running.get(pid)
+        values = sample_process(pid)
+        if record is None or values is None:
+            return
+        record['rss'] = values['rss']
+        record['peak_rss'] = max(record['peak_rss'], values['peak_rss'],
+                                 values['rss'])
+        record['cpu'] = max(record['cpu'], values['cpu'])
+
+    def stopped(self, pid, returncode):
+        record = self.running.pop(pid, None)
+        if record is None:
+            return
+        record['returncode'] = returncode
+        record['wall'] = time() - record['started_at']
+        self.logger.debug(
+            'Worker {} of {} used {} kB, {:.2f}s CPU in {:.2f}s'.format(
+                pid, record['document_id'], record['peak_rss'],
+                record['cpu'], record['wall']))
+        self.finished.append(record)
+        return record
+
+    def run(self):
+        while True:
+            sleep(self.sample_interval)
+            for pid in list(self.running):
+                self.sample(pid)
+
+    def start(self):
+        if self._worker is None:
+            self._worker = spawn(self.run)
+
+    def stop(self):
+        if self._worker is not None:
+            self._worker.kill(block=False)
+            self._worker = None
+
+    def aggregate(self, records):
+        return {
+            'count': len(records),
+            'failed': len([r for r in records if r['returncode'] != 0]),
+            'peak_rss': _summary([r['peak_rss'] for r in records]),
+            'cpu': _summary([r['cpu'] for r in records]),
+            'wall': _summary([r['wall'] for r in records]),
+            'start_delay': _summary([r['start_delay'] for r in records
+                                     if r['start_delay'] is not None]),
+        }
+
+    def aggregates(self):
+        by_type = {}
+        for record in self.finished:
+            by_type.setdefault(record['auction_type'], []).append(record)
+        return {
+            'total': self.aggregate(list(self.finished)),
+            'by_type': dict((auction_type, self.aggregate(records))
+                            for auction_type, records in by_type.items()),
+        }
+
+
+class AdmissionController(object):
+    """Predicts memory used by a worker with EWMA of peak RSS of the
+    finished workers of the same auction type.
+
+    A worker is admitted if its predicted peak, together with the growth
+    still expected from the running (or just admitted) workers, leaves
+    at least ``limit_free_memory`` part of memory free.
+    """
+
+    def __init__(self, alpha=ADMISSION_EWMA_ALPHA,
+                 default_rss=ADMISSION_DEFAULT_RSS,
+                 reservation_ttl=ADMISSION_RESERVATION_TTL,
+                 logger=getLogger(__name__)):
+        self.alpha = alpha
+        self.default_rss = default_rss
+        self.reservation_ttl = reservation_ttl
+        self.logger = logger
+        self.estimates = {}
+        self.overall = None
+        # admitted workers which are not started yet
+        self.reserved = {}
+
+    def _ewma(self, estimate, value):
+        if estimate is None:
+            return value
+        return self.alpha * value + (1 - self.alpha) * estimate
+
+    def observe(self, auction_type, peak_rss):
+        if not peak_rss:
+            return
+        self.estimates[auction_type] = self._ewma(
+            self.estimates.get(auction_type), peak_rss)
+        self.overall = self._ewma(self.overall, peak_rss)
+
+    def predict(self, auction_type):
+        """Predicted peak RSS (kB) of the worker, the average over all
+        types is used for the types without finished workers"""
+        if auction_type in self.estimates:
+            return self.estimates[auction_type]
+        return self.overall or self.default_rss
+
+    def expected_growth(self, running):
+        now = time()
+        started = set(record['document_id'] for record in running)
+        for document_id, (_, expires) in self.reserved.items():
+            if expires < now or document_id in started:
+                del self.reserved[document_id]
+        return sum(max(0, self.predict(record['auction_type']) -
+                       record['rss'])
+                   for record in running) + \
+            sum(rss for rss, _ in self.reserved.values())
+
+    def admit(self, document_id, auction_type, running, available, total,
+              limit_free_memory):
+        predicted = self.predict(auction_type)
+        free = available - self.expected_growth(running) - predicted
+        if free >= limit_free_memory * total:
+            self.reserved[document_id] = (
+                predicted, time() + self.reservation_ttl)
+            return True
+        self.logger.info(
+            'Not enough memory for {} worker: {} kB predicted, '
+            '{} kB available'.format(
+                auction_type or 'default', int(predicted), available))
+        return False
@@ -27,3 +27,11 @@ class IAuctionsChronograph(Interface):
 
 class IAuctionsServer(Interface):
     """"""
+
+
+class IAuctionPlanner(Interface):
+    """Runs auction worker commands inside the data bridge process"""
+
+    def __call__(bridge, cmd, tender_id, item, lot_id=None):
+        """Execute 'planning', 'announce' or 'cancel' for the auction,
+        NotImplementedError leaves the command to the auction worker"""
@@ -14,10 +14,13 @@ DATA_BRIDGE_PLANNING_SLEEP = 'DATA_BRIDGE_PLANNING_SLEEP'
 DATA_BRIDGE_PLANNING_RESUME = 'DATA_BRIDGE_PLANNING_RESUME'
 DATA_BRIDGE_PLANNING_COUCH_FEED = 'DATA_BRIDGE_PLANNING_COUCH_FEED'
 DATA_BRIDGE_PLANNING_COUCH_DATA_SYNC = 'DATA_BRIDGE_PLANNING_COUCH_DATA_SYNC'
+DATA_BRIDGE_PLANNING_POOL_STATS = 'DATA_BRIDGE_PLANNING_POOL_STATS'
+DATA_BRIDGE_PLANNING_CACHE_STATS = 'DATA_BRIDGE_PLANNING_CACHE_STATS'
 
 DATA_BRIDGE_RE_PLANNING_START_BRIDGE = 'DATA_BRIDGE_RE_PLANNING_START_BRIDGE'
 DATA_BRIDGE_RE_PLANNING_TENDER_ALREADY_PLANNED = 'DATA_BRIDGE_RE_PLANNING_TENDER_ALREADY_PLANNED'
 DATA_BRIDGE_RE_PLANNING_LOT_ALREADY_PLANNED = 'DATA_BRIDGE_RE_PLANNING_LOT_ALREADY_PLANNED'
+DATA_BRIDGE_RE_PLANNING_PROGRESS = 'DATA_BRIDGE_RE_PLANNING_PROGRESS'
 DATA_BRIDGE_RE_PLANNING_FINISHED = 'DATA_BRIDGE_RE_PLANNING_FINISHED'
 
 #log ID for auction_worker
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""Benchmark of the cancelled tenders lookup in the data bridge.
+
+Compares the previous approach (full ``auctions/by_endDate`` scan and
+list membership per lot) with ``AuctionsIndex.is_scheduled``.
+
+Usage: python -m openprocurement.auction.tests.benchmarks.bench_cancellation
+"""
+import argparse
+from collections import namedtuple
+from time import time
+from timeit import timeit
+from uuid import uuid4
+
+from mock import MagicMock
+
+from openprocurement.auction.helpers.databridge import AuctionsIndex
+
+
+Row = namedtuple('Row', ['id', 'key'])
+
+
+def make_rows(count):
+    end = (time() + 24 * 60 * 60) * 1000
+    return [Row(uuid4().hex, end) for _ in xrange(count)]
+
+
+def make_tenders(rows, count, lots):
+    tenders = []
+    for i in xrange(count):
+        tenders.append([rows[(i * lots + j) % len(rows)].id
+                        for j in xrange(lots)])
+    return tenders
+
+
+def view_scan(future_auctions, tenders):
+    for auction_ids in tenders:
+        for auction_id in auction_ids:
+            auction_id in [i.id for i in future_auctions]
+
+
+def index_lookup(index, tenders):
+    now = time() * 1000
+    for auction_ids in tenders:
+        for auction_id in auction_ids:
+            index.is_scheduled(auction_id, now)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='---- Cancellation lookup benchmark ----')
+    parser.add_argument('--auctions', type=int, default=100000)
+    parser.add_argument('--tenders', type=int, default=20)
+    parser.add_argument('--lots', type=int, default=3)
+    params = parser.parse_args()
+
+    rows = make_rows(params.auctions)
+    tenders = make_tenders(rows, params.tenders, params.lots)
+    index = AuctionsIndex(MagicMock())
+    index.end = dict((row.id, row.key) for row in rows)
+
+    scan = timeit(lambda: view_scan(rows, tenders), number=1)
+    lookup = timeit(lambda: index_lookup(index, tenders), number=1)
+    lookups = params.tenders * params.lots
+    print('{} future auctions, {} tenders x {} lots'.format(
+        params.auctions, params.tenders, params.lots))
+    print('view scan:    {:.4f}s ({:.6f}s per lot)'.format(
+        scan, scan / lookups))
+    print('index lookup: {:.4f}s ({:.8f}s per lot)'.format(
+        lookup, lookup / lookups))
+
+
+if __name__ == '__main__':
+    main()
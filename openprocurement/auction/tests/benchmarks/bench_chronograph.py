@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""Benchmark of the chronograph scheduler with a large auctions calendar.
+
+``AuctionsChronograph`` reads a fake ``chronograph/start_date`` view (served
+in pages to ``iterview``, like CouchDB does) and the scheduler takes locks
+in an in-memory fake Consul. Workers are not started, launches are only
+recorded. Measured:
+
+* scheduling throughput of the first view pass and of a replay of the view
+  (all auctions are already scheduled);
+* memory (RSS growth) per scheduled job;
+* lateness of launches against the planned launch time (lock, limits and
+  the launch jitter included), for ``--due`` auctions which start right
+  after the calendar is loaded.
+
+Usage:
+    python -m openprocurement.auction.tests.benchmarks.bench_chronograph \\
+        --auctions 1000 10000 50000
+"""
+from openprocurement.auction import chronograph as chrono_module
+
+import argparse
+import logging
+import os
+from bisect import bisect_left
+from datetime import datetime, timedelta
+from random import uniform
+from time import time
+
+from gevent import sleep, spawn
+from gevent.event import Event
+from mock import patch
+from pytz import timezone
+
+from openprocurement.auction.helpers import couch as couch_module
+from openprocurement.auction.helpers.chronograph import \
+    MAX_AUCTION_START_TIME_RESERV
+from openprocurement.auction.helpers.workers import sample_process
+from openprocurement.auction.tests.utils import FakeConsul
+from openprocurement.auction.utils import timestamp_key
+
+
+TIMEZONE = timezone('Europe/Kiev')
+CONFIG = {
+    'main': {
+        'couch_url': 'http://127.0.0.1:5984/',
+        'auctions_db': 'auctions',
+        'timezone': 'Europe/Kiev',
+        'use_changes_feed': False,
+        # keep the whole calendar in the scheduler
+        'scheduling_horizon': 0,
+        'sharding': False,
+        # workers are not started, so there is nothing to account
+        'admission_control': False,
+        'limit_auctions': 10 ** 6,
+        'limit_free_memory': 0,
+    }
+}
+
+
+class FakeDatabase(object):
+    """Rows of a view sorted by key, served in pages by ``start_key``"""
+
+    def __init__(self, rows):
+        self.drained = Event()
+        self.load(rows)
+
+    def load(self, rows):
+        self.rows = sorted(rows, key=lambda row: row['key'])
+        self.keys = [row['key'] for row in self.rows]
+
+    def view(self, name, wrapper=None, start_key=0, limit=1000, **options):
+        first = bisect_left(self.keys, start_key)
+        page = self.rows[first:first + limit]
+        if not page:
+            self.drained.set()
+        return page
+
+
+def make_rows(auctions, first_start, spread):
+    rows = []
+    for i in xrange(auctions):
+        start = first_start + timedelta(seconds=uniform(0, spread))
+        rows.append({
+            'id': 'UA-{:08d}'.format(i),
+            'key': timestamp_key(start),
+            'value': {'start': start.isoformat(),
+                      'procurementMethodType': 'belowThreshold'}
+        })
+    return rows
+
+
+def worker_command(item):
+    return lambda document_id: ['auction_worker', 'run', document_id]
+
+
+def rss():
+    return sample_process(os.getpid())['rss']
+
+
+def percentile(values, part):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * part))]
+
+
+def run_pass(chrono, db):
+    db.drained.clear()
+    started = time()
+    reader = spawn(chrono.run_view)
+    db.drained.wait()
+    elapsed = time() - started
+    reader.kill()
+    return elapsed
+
+
+def bench(auctions, due, spread, jobstore_path):
+    config = {'main': dict(CONFIG['main'])}
+    if jobstore_path:
+        if os.path.exists(jobstore_path):
+            os.remove(jobstore_path)
+        config['main']['jobstore_path'] = jobstore_path
+    now = datetime.now(TIMEZONE)
+    db = FakeDatabase(make_rows(auctions, now + timedelta(hours=1),
+                                7 * 24 * 60 * 60))
+    with patch.object(chrono_module, 'get_server_name',
+                      return_value='chronograph_bench'), \
+            patch.object(chrono_module, 'couchdb_dns_query_settings',
+                         return_value=db), \
+            patch.object(chrono_module, 'sync_design_chronograph'), \
+            patch.object(couch_module, 'couchdb_dns_query_settings',
+                         return_value=db), \
+            patch.object(chrono_module.components, 'qA',
+                         return_value=worker_command), \
+            patch('consul.Consul', FakeConsul):
+        chrono = chrono_module.AuctionsChronograph(config)
+        scheduler = chrono.scheduler
+        planned = {}
+        lateness = []
+
+        def launched(args, start='', auction_type='', on_exit=None):
+            lateness.append(
+                (datetime.now(TIMEZONE) - planned[args[2]]).total_seconds())
+            if on_exit:
+                on_exit()
+
+        scheduler._auction_fucn = launched
+
+        before = rss()
+        first = run_pass(chrono, db)
+        memory = float(rss() - before) / auctions
+        jobs = len(scheduler.get_jobs())
+        skipped = scheduler.schedule_stats['skipped']
+        replay = run_pass(chrono, db)
+        skipped = scheduler.schedule_stats['skipped'] - skipped
+
+        # auctions to launch within ``spread`` seconds from now
+        rows = make_rows(due, datetime.now(TIMEZONE) + timedelta(
+            seconds=2) + MAX_AUCTION_START_TIME_RESERV, spread)
+        for row in rows:
+            row['id'] = 'due-' + row['id']
+        db.load(rows)
+        run_pass(chrono, db)
+        planned.update((job.id, job.next_run_time)
+                       for job in scheduler.get_jobs()
+                       if job.id.startswith('due-'))
+        deadline = time() + spread + 60
+        while len(lateness) < len(planned) and time() < deadline:
+            sleep(1)
+        scheduler.shutdown()
+
+    print('{} auctions ({} jobs), {} due in {}s'.format(
+        auctions, jobs, due, spread))
+    print('  first pass: {:.2f}s, {:.0f} rows/s'.format(
+        first, auctions / first))
+    print('  replay:     {:.2f}s, {:.0f} rows/s, {} rows skipped'.format(
+        replay, auctions / replay, skipped))
+    print('  memory:     {:.2f} kB per job'.format(memory))
+    print('  lateness:   p50 {:.3f}s, p90 {:.3f}s, p99 {:.3f}s, '
+          'max {:.3f}s, {} of {} launched'.format(
+              percentile(lateness, 0.5), percentile(lateness, 0.9),
+              percentile(lateness, 0.99), max(lateness or [float('nan')]),
+              len(lateness), len(planned)))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='---- Chronograph scheduler benchmark ----')
+    parser.add_argument('--auctions', type=int, nargs='+',
+                        default=[1000, 10000, 50000])
+    parser.add_argument('--due', type=int, default=200,
+                        help='auctions launched during the benchmark')
+    parser.add_argument('--spread', type=int, default=30,
+                        help='seconds the due auctions are spread over')
+    parser.add_argument('--jobstore', default=None,
+                        help='path of a SQLite job store to benchmark')
+    params = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+    for auctions in params.auctions:
+        bench(auctions, params.due, params.spread, params.jobstore)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""Micro-benchmark of auction type dispatch (AuctionComponents.match).
+
+Usage: python -m openprocurement.auction.tests.benchmarks.bench_components
+"""
+import argparse
+from timeit import timeit
+
+from walkabout import PredicateMismatch
+from zope.interface import Interface
+from zope.interface.interface import InterfaceClass
+
+from openprocurement.auction.components import AuctionComponents
+from openprocurement.auction.predicates import ProcurementMethodType
+from openprocurement.auction.utils import FeedItem
+
+
+PROCUREMENT_METHOD_TYPES = [
+    'default', 'belowThreshold', 'aboveThresholdUA', 'aboveThresholdEU',
+    'competitiveDialogueEU.stage2', 'competitiveDialogueUA.stage2',
+    'aboveThresholdUA.defense', 'esco'
+]
+
+
+def make_components():
+    components = AuctionComponents()
+    components.add_predicate('procurementMethodType', ProcurementMethodType)
+    for procurement_method_type in PROCUREMENT_METHOD_TYPES:
+        iface = InterfaceClass("I{}Auction".format(procurement_method_type),
+                               bases=(Interface,))
+        components.add_auction(iface,
+                               procurementMethodType=procurement_method_type)
+    return components
+
+
+def uncached_match(components, item):
+    try:
+        return components._dispatch.lookup(item)
+    except PredicateMismatch:
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='---- Auction type dispatch benchmark ----')
+    parser.add_argument('--lookups', type=int, default=100000)
+    params = parser.parse_args()
+
+    components = make_components()
+    items = [FeedItem({'id': str(i), 'status': 'active.auction',
+                       'procurementMethodType': PROCUREMENT_METHOD_TYPES[
+                           i % len(PROCUREMENT_METHOD_TYPES)]})
+             for i in xrange(len(PROCUREMENT_METHOD_TYPES) * 10)]
+
+    def run(func):
+        for i in xrange(params.lookups):
+            func(items[i % len(items)])
+
+    before = timeit(lambda: run(
+        lambda item: uncached_match(components, item)), number=1)
+    after = timeit(lambda: run(components.match), number=1)
+    print('{} lookups over {} auction types'.format(
+        params.lookups, len(PROCUREMENT_METHOD_TYPES)))
+    print('without cache: {:.0f} lookups/s'.format(params.lookups / before))
+    print('with cache:    {:.0f} lookups/s'.format(params.lookups / after))
+
+
+if __name__ == '__main__':
+    main()
@@ -19,7 +19,8 @@ from openprocurement.auction.tests.utils import worker_defaults, \
 import yaml
 import openprocurement.auction.helpers.couch as couch_module
 import openprocurement.auction.chronograph as chrono_module
-from openprocurement.auction.tests.utils import DummyTrue, iterview_wrappper
+from openprocurement.auction.tests.utils import DummyTrue, \
+    iterview_wrappper, iterchanges_wrapper
 import pytest
 from webtest import TestApp
 from openprocurement.auction.auctions_server import auctions_server as frontend
@@ -78,13 +79,16 @@ def chronograph(request, mocker):
     logging.config.dictConfig(test_chronograph_config)
 
     # We use 'dummy_true' variable instead of real True and mock iterview
-    # with iterview_wrapper function to tear down the test gracefully.
-    # Without these steps iterview from previous test running continue working
-    # while next test have already been launched.
+    # (iterchanges) with iterview_wrapper (iterchanges_wrapper) function to
+    # tear down the test gracefully. Without these steps iterview from
+    # previous test running continue working while next test have already
+    # been launched.
     dummy_true = DummyTrue()
     couch_module.TRUE = dummy_true
     mocker.patch.object(chrono_module, 'iterview',
                         side_effect=iterview_wrappper, autospec=True)
+    mocker.patch.object(chrono_module, 'iterchanges',
+                        side_effect=iterchanges_wrapper, autospec=True)
 
     chrono = AuctionsChronograph(test_chronograph_config)
     chrono_thread = spawn(chrono.run)
@@ -138,7 +142,8 @@ def bridge(request, mocker):
     mock_do_until_success = \
         mocker.patch.object(core_module, 'do_until_success', autospec=True)
 
-    bridge_inst = AuctionsDataBridge(bridge_config)
+    bridge_inst = AuctionsDataBridge(
+        bridge_config, re_planning=params.get('re_planning', False))
     thread = spawn(bridge_inst.run)
 
     return {'bridge': bridge_inst,
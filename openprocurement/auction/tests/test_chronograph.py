@@ -1,10 +1,48 @@
 import pytest
-from openprocurement.auction.helpers.chronograph \
-    import MAX_AUCTION_START_TIME_RESERV
+import json
+import os
+import socket
 import datetime
+from calendar import timegm
+from time import time, sleep as blocking_sleep
+
+from gevent import sleep, spawn_later
+from gevent.subprocess import Popen
+from mock import MagicMock, patch
+from pytz import timezone, utc
+
+import openprocurement.auction.helpers.couch as couch_module
+from openprocurement.auction.chronograph import AuctionsChronograph
+from openprocurement.auction.helpers import chronograph, system
+from openprocurement.auction.helpers.chronograph import \
+    MAX_AUCTION_START_TIME_RESERV, AuctionScheduler, LaunchSlots, run_auction
+from openprocurement.auction.helpers.cluster import ClusterMembership, \
+    HashRing, LockManager, NodeSession, CLUSTER_PLACEMENTS_PREFIX, \
+    PLACEMENT_RETRIES
+from openprocurement.auction.helpers.prefork import WarmWorkerPool
+from openprocurement.auction.helpers.system import cgroup_memory
+from openprocurement.auction.helpers.workers import AdmissionController, \
+    ChildSupervisor, WorkerAccounting
 from openprocurement.auction.tests.utils import job_is_added, \
-    job_is_not_added, job_is_active, job_is_not_active
-from time import sleep as blocking_sleep
+    job_is_not_added, job_is_active, job_is_not_active, DummyTrue, \
+    FakeConsul
+
+
+def make_scheduler(mocker, consul, server_name, **config):
+    """Scheduler of the chronograph node connected to the fake Consul"""
+    mocker.patch('consul.Consul', return_value=consul)
+    config.setdefault('limit_free_memory', 0)
+    return AuctionScheduler(server_name, {'main': config}, timezone=utc)
+
+
+def load(workers, free_memory=0.5):
+    return {'workers': workers, 'limit_auctions': 10, 'cpu': 0.1,
+            'free_memory': free_memory, 'limit_free_memory': 0.15}
+
+
+def placement(consul, document_id):
+    _, item = consul.kv.get(CLUSTER_PLACEMENTS_PREFIX + document_id)
+    return json.loads(item['Value'])
 
 
 class TestChronograph(object):
@@ -77,3 +115,589 @@ class TestChronograph(object):
     #     assert resp.status_code == 200
     #     assert resp.text == '"Start shutdown"'
     #
+
+
+class TestIterChanges(object):
+    def test_resume_after_error(self, mocker):
+        database = mocker.MagicMock()
+        database.changes.side_effect = [
+            iter([{'seq': 1, 'id': 'a', 'doc': {}},
+                  {'seq': 2, 'id': 'b', 'deleted': True},
+                  {'last_seq': 2}]),
+            socket.error(),
+            iter([{'seq': 3, 'id': 'c', 'doc': {}}]),
+        ]
+        mocker.patch.object(couch_module, 'couchdb_dns_query_settings',
+                            return_value=database)
+        mocker.patch.object(couch_module, 'TRUE', DummyTrue())
+        changes = couch_module.iterchanges('url', 'db', 'chronograph/waiting',
+                                           since=0, sleep_seconds=0)
+        assert [next(changes)['id'], next(changes)['id']] == ['a', 'c']
+        assert [c[1]['since'] for c in database.changes.call_args_list] == \
+            [0, 2, 2]
+        assert database.changes.call_args[1]['filter'] == \
+            'chronograph/waiting'
+
+
+class TestSchedulingHorizon(object):
+    def make_chronograph(self, mocker, horizon):
+        chrono = AuctionsChronograph.__new__(AuctionsChronograph)
+        chrono.timezone = timezone('Europe/Kiev')
+        chrono.scheduling_horizon = datetime.timedelta(seconds=horizon)
+        chrono.scheduler = mocker.MagicMock()
+        chrono.scheduler.cluster = None
+        chrono.scheduler.unchanged.return_value = False
+        chrono.scheduler.convert_datetime.side_effect = \
+            lambda start: start
+        chrono.mapper = mocker.MagicMock()
+        return chrono
+
+    def item(self, chrono, delta):
+        start = datetime.datetime.now(chrono.timezone) + delta
+        return {'id': 'UA-1', 'value': {'start': start}}
+
+    def test_beyond_horizon(self, mocker):
+        chrono = self.make_chronograph(mocker, 7200)
+        chrono.scheduler.get_job.return_value = None
+        assert not chrono.beyond_horizon(
+            self.item(chrono, datetime.timedelta(hours=1)))
+        assert chrono.beyond_horizon(
+            self.item(chrono, datetime.timedelta(hours=3)))
+        assert not chrono.scheduler.unschedule_auction.called
+
+    def test_rescheduled_beyond_horizon(self, mocker):
+        chrono = self.make_chronograph(mocker, 7200)
+        chrono.schedule(self.item(chrono, datetime.timedelta(hours=3)))
+        chrono.scheduler.unschedule_auction.assert_called_once_with('UA-1')
+        assert not chrono.scheduler.schedule_auction.called
+
+    def test_owner_keeps_job_placed_on_other_node(self, mocker):
+        chrono = self.make_chronograph(mocker, 0)
+        cluster = chrono.scheduler.cluster = mocker.MagicMock()
+        cluster.server_name = 'node_a'
+        cluster.owns.return_value = False
+        cluster.owner.return_value = 'node_a'
+        item = self.item(chrono, datetime.timedelta(hours=1))
+        assert not chrono.owned_by_other(item)
+        cluster.owner.return_value = 'node_b'
+        assert chrono.owned_by_other(item)
+        chrono.scheduler.unschedule_auction.assert_called_once_with('UA-1')
+
+    def test_changes_since_needs_persistent_jobs(self, mocker, tmpdir):
+        chrono = self.make_chronograph(mocker, 0)
+        since_file = tmpdir.join('since')
+        since_file.write('42')
+        chrono.changes_since_file = str(since_file)
+        chrono.scheduler.jobstore = None
+        assert chrono.load_changes_since() == 0
+        chrono.scheduler.jobstore = mocker.MagicMock()
+        assert chrono.load_changes_since() == '42'
+
+    def test_no_horizon(self, mocker):
+        chrono = self.make_chronograph(mocker, 0)
+        assert not chrono.beyond_horizon(
+            self.item(chrono, datetime.timedelta(days=30)))
+
+
+class TestCluster(object):
+    def test_hash_ring_moves_only_departed_keys(self):
+        keys = ['UA-{}'.format(i) for i in range(1000)]
+        full = HashRing(['a', 'b', 'c'])
+        reduced = HashRing(['a', 'b'])
+        moved = [key for key in keys
+                 if full.owner(key) != reduced.owner(key)]
+        assert moved == [key for key in keys if full.owner(key) == 'c']
+        assert 200 < len(moved) < 467
+
+    def test_membership(self):
+        consul = FakeConsul()
+        node_a, node_b = [ClusterMembership(consul, name,
+                                            NodeSession(consul, name))
+                          for name in ('node_a', 'node_b')]
+        node_a.register()
+        node_b.register()
+        # the key of a node which is gone, not held by a session
+        consul.kv.put('chronograph_nodes/node_c', 'node_c')
+        node_a.update()
+        assert node_a.ring.nodes == frozenset(['node_a', 'node_b'])
+        assert set(node_a.owner('UA-{}'.format(i)) for i in range(100)) == \
+            set(['node_a', 'node_b'])
+        # the session of node_b expires with its key
+        node_b.session.stop()
+        node_a.update()
+        assert node_a.ring.nodes == frozenset(['node_a'])
+
+    def test_not_owned_auction_is_watched(self, mocker):
+        consul = FakeConsul()
+        scheduler = make_scheduler(mocker, consul, 'node_b', sharding=True)
+        owner = ClusterMembership(consul, 'node_a',
+                                  NodeSession(consul, 'node_a'))
+        owner.register()
+        scheduler.cluster.register()
+        scheduler.cluster.update()
+        document_id = next(
+            document_id for document_id in
+            ('UA-{}'.format(i) for i in range(100))
+            if scheduler.cluster.owner(document_id) == 'node_a')
+        owner.session.acquire('auction_' + document_id, 'node_a')
+        scheduler._auction_fucn = mocker.MagicMock()
+        start = datetime.datetime.now(utc) + datetime.timedelta(minutes=5)
+        scheduler.run_auction_func(['auction_worker', 'run', document_id],
+                                   start=start.isoformat())
+        assert not scheduler._auction_fucn.called
+        assert document_id in scheduler.lock_watchers
+        # the owner dies while the auction runs, it is taken over
+        owner.session.stop()
+        scheduler.lock_watchers[document_id].join(1)
+        assert scheduler._auction_fucn.call_count == 1
+        assert consul.kv.get('auction_' + document_id)[1]['Session'] == \
+            scheduler.session.id
+
+    def test_owner_missed_waits_within_start_reserve(self, mocker):
+        consul = FakeConsul()
+        scheduler = make_scheduler(mocker, consul, 'node_b', sharding=True,
+                                   shard_fallback_delay=600)
+        now = datetime.datetime.now(utc)
+        # less than the minimal start reserve is left
+        started_at = time()
+        assert scheduler.owner_missed(
+            'UA-1', (now + datetime.timedelta(seconds=30)).isoformat())
+        assert time() - started_at < 1
+        owner = NodeSession(consul, 'node_a')
+        spawn_later(0.05, owner.acquire, 'auction_UA-1', 'node_a')
+        assert not scheduler.owner_missed(
+            'UA-1', (now + datetime.timedelta(minutes=5)).isoformat())
+
+    def test_placement_on_least_loaded_node(self):
+        consul = FakeConsul()
+        for name, node_load in [('node_b', load(2)),
+                                ('node_c', load(0, free_memory=0.1))]:
+            ClusterMembership(consul, name, NodeSession(consul, name),
+                              load=lambda node_load=node_load: node_load
+                              ).register()
+        consul.kv.put(CLUSTER_PLACEMENTS_PREFIX + 'UA-2',
+                      json.dumps({'node': 'node_b'}))
+        consul.kv.put(CLUSTER_PLACEMENTS_PREFIX + 'UA-3',
+                      json.dumps({'node': 'node_a', 'args': []}))
+        on_placement = MagicMock()
+        cluster = ClusterMembership(consul, 'node_a',
+                                    NodeSession(consul, 'node_a'),
+                                    load=lambda: load(3),
+                                    on_placement=on_placement)
+        cluster.update()
+        on_placement.assert_called_once_with(
+            'UA-3', {'node': 'node_a', 'args': []})
+        # node_c is out of memory, node_b has 2 workers and 1 placement
+        assert cluster.place('UA-1', {'start': '', 'args': []}) == 'node_b'
+        assert placement(consul, 'UA-1')['node'] == 'node_b'
+        assert cluster.placed('UA-1') == 'node_b'
+        assert not cluster.owns('UA-1')
+        assert cluster.owns('UA-3')
+        # placed already
+        assert cluster.place('UA-2', {'start': '', 'args': []}) == 'node_b'
+
+    def test_placement_on_dead_node_ignored(self):
+        consul = FakeConsul()
+        consul.kv.put(CLUSTER_PLACEMENTS_PREFIX + 'UA-1',
+                      json.dumps({'node': 'node_dead'}))
+        cluster = ClusterMembership(consul, 'node_a',
+                                    NodeSession(consul, 'node_a'))
+        cluster.update()
+        assert cluster.placed('UA-1') is None
+        assert cluster.owns('UA-1')
+        assert cluster.place('UA-1', {'start': '', 'args': []}) == 'node_a'
+        assert placement(consul, 'UA-1')['node'] == 'node_a'
+        assert cluster.placed('UA-1') == 'node_a'
+
+    def test_placement_retries_limited(self):
+        consul = FakeConsul()
+        cluster = ClusterMembership(consul, 'node_a',
+                                    NodeSession(consul, 'node_a'))
+        put = consul.kv.put
+
+        def racing_put(key, value, **kwargs):
+            # other node writes the placement on a dead node every time
+            put(key, json.dumps({'node': 'node_dead'}))
+            return put(key, value, **kwargs)
+
+        with patch.object(consul.kv, 'put', side_effect=racing_put) as kv_put:
+            assert cluster.place('UA-1', {'start': '', 'args': []}) == \
+                'node_a'
+        assert kv_put.call_count == PLACEMENT_RETRIES
+        assert 'UA-1' not in cluster.placements
+
+    def test_hand_off_checks_modify_index(self):
+        consul = FakeConsul()
+        ClusterMembership(consul, 'node_b', NodeSession(consul, 'node_b'),
+                          load=lambda: load(0)).register()
+        cluster = ClusterMembership(consul, 'node_a',
+                                    NodeSession(consul, 'node_a'),
+                                    load=lambda: load(10))
+        cluster.update()
+        consul.kv.put(CLUSTER_PLACEMENTS_PREFIX + 'UA-1',
+                      json.dumps({'node': 'node_a'}))
+        get = consul.kv.get
+
+        def racing_get(key, **kwargs):
+            result = get(key, **kwargs)
+            # other node moves the auction after it was read
+            consul.kv.put(key, json.dumps({'node': 'node_c'}))
+            return result
+
+        with patch.object(consul.kv, 'get', side_effect=racing_get):
+            assert cluster.hand_off('UA-1', {'start': '', 'args': []}) \
+                is None
+        assert placement(consul, 'UA-1') == {'node': 'node_c'}
+        assert 'UA-1' not in cluster.placements
+        assert cluster.hand_off('UA-1', {'start': '', 'args': []}) == \
+            'node_b'
+        assert placement(consul, 'UA-1')['node'] == 'node_b'
+        assert cluster.placed('UA-1') == 'node_b'
+
+    def test_batched_lock_claim(self):
+        consul = FakeConsul()
+        other = NodeSession(consul, 'node_b')
+        other.acquire('auction_UA-1', 'node_b')
+        session = NodeSession(consul, 'node_a')
+        session.acquire('auction_UA-2', 'node_a')
+        locks = LockManager(consul, session)
+        txn_put = consul.txn.put
+
+        def racing_txn(payload):
+            # UA-4 is locked by other node between the read and the
+            # transaction
+            other.acquire('auction_UA-4', 'node_b')
+            return txn_put(payload)
+
+        with patch.object(consul.txn, 'put', side_effect=racing_txn) as txn:
+            won, lost = locks.claim(
+                ['auction_UA-{}'.format(i) for i in range(1, 6)], 'node_a')
+        assert sorted(won) == ['auction_UA-2', 'auction_UA-3', 'auction_UA-5']
+        assert sorted(lost) == ['auction_UA-1', 'auction_UA-4']
+        assert [op['KV']['Key'] for op in txn.call_args[0][0]] == \
+            ['auction_UA-3', 'auction_UA-5']
+        assert consul.kv.get('auction_UA-3')[1]['Session'] == session.id
+        assert list(locks.windows)[-1]['won'] == 3
+        assert locks.take('auction_UA-3')
+        assert not locks.take('auction_UA-3')
+        assert locks.is_lost('auction_UA-4')
+        locks.drop('auction_UA-5')
+        assert consul.kv.get('auction_UA-5')[1] is None
+        assert 'auction_UA-5' not in session.locks
+
+    def test_lock_held_by_other_node(self, mocker):
+        consul = FakeConsul()
+        NodeSession(consul, 'node_b').acquire('auction_UA-1', 'node_b')
+        scheduler = make_scheduler(mocker, consul, 'node_a')
+        sleep = mocker.patch.object(chronograph, 'sleep')
+        assert not scheduler.acquire_lock('auction_UA-1')
+        assert not sleep.called
+
+    def test_lost_lock_taken_over(self, mocker):
+        consul = FakeConsul()
+        scheduler = make_scheduler(mocker, consul, 'node_a')
+        # the winner of the window dropped its claim
+        scheduler.locks.lost['auction_UA-1'] = time()
+        scheduler._auction_fucn = mocker.MagicMock()
+        scheduler._watch_lock(['auction_worker', 'run', 'UA-1'], '', 'UA-1',
+                              '', time() + 60)
+        assert consul.kv.get('auction_UA-1')[1]['Session'] == \
+            scheduler.session.id
+        assert scheduler._auction_fucn.call_count == 1
+        assert not scheduler.locks.is_lost('auction_UA-1')
+        assert not scheduler.lock_watchers
+
+    def test_wait_expired(self):
+        consul = FakeConsul()
+        other = NodeSession(consul, 'node_b')
+        other.acquire('auction_UA-1', 'node_b')
+        session = NodeSession(consul, 'node_a')
+        # node_b dies
+        spawn_later(0.05, other.stop)
+        assert session.wait_expired('auction_UA-1', time() + 5)
+        # the worker of the holder is finished
+        other.acquire('auction_UA-1', 'node_b')
+        spawn_later(0.05, other.release, 'auction_UA-1')
+        assert not session.wait_expired('auction_UA-1', time() + 5)
+
+    def test_wait_locked(self):
+        consul = FakeConsul()
+        session = NodeSession(consul, 'node_b')
+        owner = NodeSession(consul, 'node_a')
+        spawn_later(0.05, owner.acquire, 'auction_UA-1', 'node_a')
+        assert session.wait_locked('auction_UA-1', time() + 5)
+        assert not session.wait_locked('auction_UA-2', time() - 1)
+
+    def test_shared_session(self):
+        consul = FakeConsul()
+        session = NodeSession(consul, 'node')
+        assert session.acquire('auction_UA-1', 'node')
+        assert session.acquire('auction_UA-2', 'node')
+        assert len(consul.session.sessions) == 1
+        session.release('auction_UA-1')
+        assert consul.kv.get('auction_UA-1')[1] is None
+        # the lost session is replaced and the held locks are acquired again
+        lost = session.id
+        consul.session.destroy(lost)
+        assert session.renew() != lost
+        assert consul.kv.get('auction_UA-2')[1]['Session'] == session.id
+
+
+class TestWarmWorkerPool(object):
+    def test_run(self, tmpdir):
+        script = tmpdir.join('auction_worker')
+        script.write(
+            'import sys, json\n'
+            'open(sys.argv[-1], "w").write(json.dumps(\n'
+            '    [sys.argv, "json" in sys.modules]))\n')
+        output = str(tmpdir.join('output'))
+        pool = WarmWorkerPool(1, preload=['json'])
+        pool.fill()
+        assert len(pool.idle) == 1
+        process = pool.run([str(script), 'run', 'UA-1', output])
+        assert process.wait() == 0
+        assert json.load(open(output)) == \
+            [[str(script), 'run', 'UA-1', output], True]
+        assert (pool.hits, pool.misses) == (1, 0)
+        pool.stop()
+        assert not pool.idle
+
+
+class TestLaunchSlots(object):
+    def test_spread_launches(self):
+        slots = LaunchSlots(2, min_lead=datetime.timedelta(seconds=60),
+                            timezone=utc)
+        start = datetime.datetime(2100, 1, 1, 12, 0, tzinfo=utc)
+        earliest = start - MAX_AUCTION_START_TIME_RESERV
+        launches = [slots.reserve('UA-{}'.format(i), earliest, start)
+                    for i in range(5)]
+        assert [(l - earliest).total_seconds() for l in launches] == \
+            [0, 0, 1, 1, 2]
+        # re-planning of the auction frees its slot
+        assert slots.reserve('UA-4', earliest, start) == launches[4]
+        slots.release('UA-0')
+        assert slots.reserve('UA-5', earliest, start) == earliest
+        assert slots.histogram() == [('2100-01-01T11:45:00+00:00', 5)]
+
+    def test_min_lead(self):
+        slots = LaunchSlots(1, min_lead=datetime.timedelta(seconds=60))
+        start = datetime.datetime(2100, 1, 1, 12, 0, tzinfo=utc)
+        earliest = start - datetime.timedelta(seconds=62)
+        launches = [slots.reserve('UA-{}'.format(i), earliest, start)
+                    for i in range(5)]
+        assert max(launches) == start - datetime.timedelta(seconds=60)
+
+    def test_far_auction_keeps_earlier_slots(self):
+        slots = LaunchSlots(1, min_lead=datetime.timedelta(seconds=60))
+        start = datetime.datetime(2100, 1, 1, 12, 15, tzinfo=utc)
+        earliest = start - MAX_AUCTION_START_TIME_RESERV
+        first = slots.reserve('UA-A', earliest, start)
+        far = start + datetime.timedelta(days=1)
+        slots.reserve('UA-Z', far - MAX_AUCTION_START_TIME_RESERV, far)
+        second = slots.reserve('UA-B', earliest, start)
+        assert first != second
+
+    def test_prune_past_launches(self):
+        slots = LaunchSlots(1, min_lead=datetime.timedelta(seconds=60))
+        start = datetime.datetime(2100, 1, 1, 12, 0, tzinfo=utc)
+        earliest = start - datetime.timedelta(seconds=70)
+        first = slots.reserve('UA-A', earliest, start)
+        slots.reserve('UA-B', earliest, start)
+        # moved launch leaves a stale entry for its old second
+        slots.reserve('UA-A', earliest + datetime.timedelta(seconds=5), start)
+        slots.prune(timegm(first.utctimetuple()) + 2)
+        assert sorted(slots.launches) == ['UA-A']
+        assert slots.expiry == [(slots.launches['UA-A'], 'UA-A')]
+        assert sum(slots.slots.values()) == 1
+
+
+class TestResourceMonitor(object):
+    def cgroup_files(self, tmpdir, limit, usage):
+        tmpdir.join('memory.max').write(limit)
+        tmpdir.join('memory.current').write(usage)
+        tmpdir.join('memory.stat').write('anon 10\ninactive_file 100\n')
+        return [str(tmpdir.join(name)) for name in
+                ('memory.max', 'memory.current', 'memory.stat')]
+
+    def test_cgroup_memory(self, tmpdir):
+        assert cgroup_memory(
+            self.cgroup_files(tmpdir, '10240\n', '5220\n')) == (5, 10)
+        assert cgroup_memory(
+            self.cgroup_files(tmpdir, 'max\n', '600\n')) is None
+
+    def test_cached_values(self, mocker, tmpdir):
+        mocker.patch.object(system, 'host_memory', return_value=(90, 100))
+        mocker.patch.object(system, 'cgroup_memory_files',
+                            return_value=self.cgroup_files(
+                                tmpdir, '10240\n', '8292\n'))
+        monitor = system.ResourceMonitor()
+        assert (monitor.available_memory, monitor.total_memory) == (2, 10)
+        assert monitor.free_memory == 0.2
+        assert monitor.processes > 0
+        system.host_memory.return_value = (10, 100)
+        assert monitor.free_memory == 0.2
+        monitor.sample()
+        assert monitor.free_memory == 0.1
+
+
+class TestWorkerAccounting(object):
+    def test_accounting(self):
+        workers = WorkerAccounting()
+        workers.started(os.getpid(), 'UA-1', 'belowThreshold', -900.0)
+        assert workers.running[os.getpid()]['peak_rss'] > 0
+        workers.stopped(os.getpid(), 0)
+        workers.started(-1, 'UA-2', 'belowThreshold', -600.0)
+        workers.stopped(-1, 1)
+        assert not workers.running
+        aggregates = workers.aggregates()
+        assert aggregates['total']['count'] == 2
+        assert aggregates['by_type']['belowThreshold']['failed'] == 1
+        assert aggregates['total']['start_delay'] == \
+            {'avg': -750.0, 'max': -600.0}
+
+
+class TestAdmissionController(object):
+    def test_predict(self):
+        admission = AdmissionController(alpha=0.5, default_rss=100)
+        assert admission.predict('esco') == 100
+        admission.observe('esco', 400)
+        admission.observe('esco', 200)
+        admission.observe('belowThreshold', 100)
+        assert admission.predict('esco') == 300
+        assert admission.predict('belowThreshold') == 100
+        # the average over all types for unknown types
+        assert admission.predict('dgfOtherAssets') == 200
+
+    def test_admit(self):
+        admission = AdmissionController(default_rss=100)
+        running = [{'document_id': 'UA-1', 'auction_type': '', 'rss': 40}]
+        # 1000 available, 60 of running growth, 100 for new, 150 reserve
+        assert admission.admit('UA-2', '', running, 1000, 1000, 0.15)
+        # UA-2 is reserved until it is started
+        assert not admission.admit('UA-3', '', running, 400, 1000, 0.15)
+        running.append({'document_id': 'UA-2', 'auction_type': '',
+                        'rss': 100})
+        assert admission.admit('UA-3', '', running, 400, 1000, 0.15)
+
+    def test_defer(self, mocker):
+        scheduler = AuctionScheduler(
+            'node', {'main': {'use_consul': False, 'admission_defer': 10}},
+            timezone=utc)
+        add_job = mocker.patch.object(scheduler, 'add_job')
+        now = datetime.datetime.now(utc)
+        scheduler.defer_auction(
+            [], (now + datetime.timedelta(minutes=5)).isoformat(), 'UA-1', '')
+        assert add_job.call_args[1]['id'] == 'UA-1'
+        add_job.reset_mock()
+        scheduler.defer_auction(
+            [], (now + datetime.timedelta(seconds=65)).isoformat(), 'UA-1', '')
+        assert not add_job.called
+
+
+class TestPersistentJobStore(object):
+    def make_scheduler(self, path):
+        config = {'main': {'use_consul': False, 'jobstore_path': path}}
+        scheduler = AuctionScheduler('node', config, timezone=utc)
+        scheduler.start()
+        return scheduler
+
+    def test_jobs_restored(self, tmpdir):
+        path = str(tmpdir.join('jobs.sqlite'))
+        scheduler = self.make_scheduler(path)
+        start = datetime.datetime.now(utc) + datetime.timedelta(hours=1)
+        scheduler.schedule_auction(
+            'UA-1', {'start': start.isoformat(),
+                     'procurementMethodType': 'belowThreshold'},
+            args=['auction_worker', 'run', 'UA-1'])
+        scheduler.jobstore.set_meta('changes_since', '42')
+        scheduler.shutdown()
+
+        scheduler = self.make_scheduler(path)
+        job = scheduler.get_job('UA-1')
+        assert job.kwargs['args'] == ['auction_worker', 'run', 'UA-1']
+        assert job.kwargs['auction_type'] == 'belowThreshold'
+        scheduler.schedule_auction(
+            'UA-1', {'start': start.isoformat(),
+                     'procurementMethodType': 'belowThreshold'},
+            args=['auction_worker', 'run', 'UA-1'])
+        assert scheduler.get_job('UA-1').next_run_time == job.next_run_time
+        assert 'UA-1' in scheduler.scheduled
+        assert scheduler.jobstore.get_meta('changes_since') == '42'
+        scheduler.unschedule_auction('UA-1')
+        assert scheduler.get_jobs() == []
+        scheduler.shutdown()
+
+    def test_missed_jobs_rescheduled(self, tmpdir):
+        path = str(tmpdir.join('jobs.sqlite'))
+        config = {'main': {'use_consul': False, 'jobstore_path': path}}
+        scheduler = AuctionScheduler('node', config, timezone=utc)
+        scheduler.start(paused=True)
+        now = datetime.datetime.now(utc)
+        for document_id, start in [('UA-1', datetime.timedelta(minutes=10)),
+                                   ('UA-2', datetime.timedelta(seconds=30))]:
+            scheduler.add_job(
+                run_auction, id=document_id, misfire_grace_time=60,
+                next_run_time=now - datetime.timedelta(minutes=5),
+                kwargs={'args': [], 'document_id': document_id,
+                        'start': (now + start).isoformat()})
+        scheduler.shutdown()
+
+        scheduler = AuctionScheduler('node', config, timezone=utc)
+        scheduler.start(paused=True)
+        assert [job.id for job in scheduler.get_jobs()] == ['UA-1']
+        assert scheduler.get_job('UA-1').next_run_time >= now
+        scheduler.shutdown()
+
+
+class TestScheduleChanges(object):
+    def test_unchanged_rows_skipped(self, mocker):
+        scheduler = AuctionScheduler(
+            'node', {'main': {'use_consul': False}}, timezone=utc)
+        scheduler.start()
+        start = datetime.datetime.now(utc) + datetime.timedelta(hours=1)
+        value = {'start': start.isoformat(), 'auction_type': 'default'}
+        args = ['auction_worker', 'run', 'UA-1']
+        assert not scheduler.unchanged('UA-1', value)
+        scheduler.schedule_auction('UA-1', value, args=args)
+        get_job = mocker.spy(scheduler, 'get_job')
+        assert scheduler.unchanged('UA-1', dict(value))
+        scheduler.schedule_auction('UA-1', dict(value), args=args)
+        assert not get_job.called
+        assert scheduler.skip_rate == 0.5
+
+        moved = dict(value, start=(start + datetime.timedelta(
+            minutes=5)).isoformat())
+        assert not scheduler.unchanged('UA-1', moved)
+        scheduler.schedule_auction('UA-1', moved, args=args)
+        assert scheduler.get_job('UA-1').kwargs['start'] == moved['start']
+        scheduler.unschedule_auction('UA-1')
+        assert not scheduler.unchanged('UA-1', moved)
+        scheduler.shutdown()
+
+
+class TestChildSupervisor(object):
+    def test_exit_callbacks(self):
+        supervisor = ChildSupervisor()
+        exits = []
+        process = Popen(['sh', '-c', 'exit 3'])
+        supervisor.watch(process, lambda *args: exits.append(args), 'x')
+        killed = Popen(['sleep', '5'])
+        supervisor.watch(killed, lambda *args: exits.append(args))
+        killed.terminate()
+        for _ in range(50):
+            if len(exits) == 2:
+                break
+            sleep(0.1)
+        assert sorted(exits) == sorted([(process.pid, 3, 'x'),
+                                        (killed.pid, -15)])
+        assert len(supervisor) == 0
+
+    def test_exited_before_watch(self):
+        supervisor = ChildSupervisor()
+        exits = []
+        process = Popen(['true'])
+        process.wait()
+        supervisor.watch(process, lambda *args: exits.append(args))
+        sleep(0.1)
+        assert exits == [(process.pid, 0)]
+        assert len(supervisor) == 0
@@ -1,4 +1,27 @@
-from openprocurement.auction.core import compoenents
+import pytest
+from dateutil.tz import tzutc
+from mock import MagicMock
+from zope.interface import Interface
+from zope.interface.interface import InterfaceClass
+
+from openprocurement.auction import components as components_module
+from openprocurement.auction import core as core_module
+from openprocurement.auction.components import AuctionComponents
+from openprocurement.auction.predicates import ProcurementMethodType
+from openprocurement.auction.utils import FeedItem
+
+
+def make_components(*procurement_method_types):
+    registry = AuctionComponents()
+    registry.add_predicate('procurementMethodType', ProcurementMethodType)
+    ifaces = {}
+    for procurement_method_type in procurement_method_types:
+        iface = InterfaceClass("I{}Auction".format(procurement_method_type),
+                               bases=(Interface,))
+        registry.add_auction(iface,
+                             procurementMethodType=procurement_method_type)
+        ifaces[procurement_method_type] = iface
+    return registry, ifaces
 
 
 class TestDispatch(object):
@@ -11,3 +34,192 @@ class TestDispatch(object):
 
     def test_adapters(self):
         pass
+
+    def test_match_cached(self, mocker):
+        registry, ifaces = make_components('default', 'esco')
+        lookup = mocker.spy(registry._dispatch, 'lookup')
+        item = FeedItem({'procurementMethodType': 'esco'})
+
+        assert registry.match(item) is ifaces['esco']
+        assert registry.match(FeedItem(item)) is ifaces['esco']
+        assert lookup.call_count == 1
+
+        assert registry.match(FeedItem()) is ifaces['default']
+        assert registry.match(FeedItem({'procurementMethodType': 'unknown'})) is None
+        assert lookup.call_count == 3
+
+    def test_match_cache_invalidated(self):
+        registry, ifaces = make_components('default')
+        item = FeedItem({'procurementMethodType': 'esco'})
+        assert registry.match(item) is None
+
+        iface = InterfaceClass("IescoAuction", bases=(Interface,))
+        registry.add_auction(iface, procurementMethodType='esco')
+        assert registry.match(item) is iface
+
+
+PLUGIN_IMPORT_TIME = 0.2
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def make_entry_point(name, registry_ifaces, clock):
+    def plugin(registry):
+        iface = InterfaceClass("I{}Auction".format(name), bases=(Interface,))
+        registry.add_auction(iface, procurementMethodType=name)
+        registry_ifaces[name] = iface
+
+    def load():
+        clock.sleep(PLUGIN_IMPORT_TIME)  # heavy worker modules import
+        return plugin
+
+    entry_point = MagicMock()
+    entry_point.name = name
+    entry_point.load = MagicMock(side_effect=load)
+    return entry_point
+
+
+class TestLazyPlugins(object):
+    names = ['default', 'belowThreshold', 'aboveThresholdUA', 'esco']
+
+    def setup_manager(self, mocker, lazy=True):
+        registry, _ = make_components()
+        ifaces = {}
+        clock = FakeClock()
+        entry_points = [make_entry_point(name, ifaces, clock)
+                        for name in self.names]
+        mocker.patch.object(core_module, 'components', registry)
+        mocker.patch.object(core_module, 'iter_entry_points',
+                            return_value=entry_points)
+        for_ = MagicMock()
+        for_.config = {'main': {'plugins': self.names, 'lazy_plugins': lazy}}
+        started_at = clock.time()
+        manager = core_module.AuctionManager(for_)
+        return manager, clock.time() - started_at, entry_points, ifaces, \
+            registry
+
+    def test_startup_time(self, mocker):
+        _, eager_time, _, _, _ = self.setup_manager(mocker, lazy=False)
+        _, lazy_time, _, _, _ = self.setup_manager(mocker)
+
+        assert eager_time == PLUGIN_IMPORT_TIME * len(self.names)
+        assert lazy_time == PLUGIN_IMPORT_TIME
+
+    def test_plugin_loaded_on_first_match(self, mocker):
+        _, _, entry_points, ifaces, registry = self.setup_manager(mocker)
+        loads = dict((ep.name, ep.load) for ep in entry_points)
+        assert loads['default'].call_count == 1
+        assert loads['esco'].call_count == 0
+
+        assert registry.match(FeedItem({'procurementMethodType': 'esco'})) \
+            is ifaces['esco']
+        assert registry.match(FeedItem({'procurementMethodType': 'esco'})) \
+            is ifaces['esco']
+        assert loads['esco'].call_count == 1
+        assert loads['belowThreshold'].call_count == 0
+
+    def test_warning_when_no_plugin_matched(self, mocker):
+        _, _, entry_points, _, registry = self.setup_manager(mocker)
+        warning = mocker.patch.object(components_module.LOGGER, 'warning')
+
+        assert registry.match(
+            FeedItem({'procurementMethodType': 'reporting'})) is None
+        assert warning.call_count == 1
+        assert 'reporting' in warning.call_args[0][0]
+        assert 'aboveThresholdUA, belowThreshold, esco' in \
+            warning.call_args[0][0]
+        assert not any(ep.load.called for ep in entry_points
+                       if ep.name != 'default')
+
+
+class TestPlanning(object):
+
+    def test_announce_only_pre_announced_lots(self, mocker):
+        view = mocker.patch.object(
+            core_module, 'PreAnnounce_by_id_view',
+            return_value=[MagicMock(id='UA-1_lot-1')])
+        item = {'id': 'UA-1', 'status': 'active.qualification',
+                'lots': [{'id': 'lot-1', 'status': 'active'},
+                         {'id': 'lot-2', 'status': 'active'},
+                         {'id': 'lot-3', 'status': 'cancelled'}]}
+        bridge = MagicMock()
+
+        assert list(core_module.Planning(bridge, item)) == \
+            [('announce', 'UA-1', 'lot-1')]
+        view.assert_called_once_with(bridge.db,
+                                     keys=['UA-1_lot-1', 'UA-1_lot-2'])
+
+    def test_no_view_lookup_without_active_lots(self, mocker):
+        view = mocker.patch.object(core_module, 'PreAnnounce_by_id_view')
+        item = {'id': 'UA-1', 'status': 'active.qualification',
+                'lots': [{'id': 'lot-1', 'status': 'cancelled'}]}
+
+        assert list(core_module.Planning(MagicMock(), item)) == []
+        assert not view.called
+
+    def test_re_planning_skip_counted(self):
+        bridge = MagicMock()
+        bridge.tz = tzutc()
+        bridge.re_planning = True
+        bridge.re_planned_ids = set(['UA-1'])
+        bridge.re_planning_skipped = 0
+        item = {'id': 'UA-1', 'status': 'active.auction',
+                'auctionPeriod': {'startDate': '2100-06-28T10:32:19+03:00'}}
+
+        assert list(core_module.Planning(bridge, item)) == []
+        assert bridge.re_planning_skipped == 1
+
+    def test_planner_leaves_command_to_worker(self, mocker):
+        do_until_success = mocker.patch.object(core_module, 'do_until_success')
+        error = mocker.patch.object(core_module.LOGGER, 'error')
+        bridge = MagicMock()
+        bridge.in_process_planning = True
+        bridge.config = {'main': {'auction_worker': 'auction_worker',
+                                  'auction_worker_config': 'worker.yaml'}}
+        planner = core_module.DefaultPlanner()
+        core_module.components.registerUtility(
+            planner, core_module.IAuctionPlanner, name='default')
+        try:
+            core_module.Planning(bridge, {'id': 'UA-1'})('planning', 'UA-1')
+        finally:
+            core_module.components.unregisterUtility(
+                planner, core_module.IAuctionPlanner, name='default')
+
+        assert do_until_success.call_count == 1
+        assert not error.called
+
+
+class TestDefaultPlanner(object):
+
+    def test_cancel(self):
+        bridge = MagicMock()
+        bridge.db.get.return_value = {'_id': 'UA-1_lot-1', 'current_stage': 0}
+
+        assert core_module.DefaultPlanner()(
+            bridge, 'cancel', 'UA-1', {}, lot_id='lot-1') == 'UA-1_lot-1'
+        bridge.db.get.assert_called_once_with('UA-1_lot-1')
+        doc = bridge.db.save.call_args[0][0]
+        assert doc['current_stage'] == -100
+        assert 'endDate' in doc
+
+    def test_cancel_missing_auction(self):
+        bridge = MagicMock()
+        bridge.db.get.return_value = None
+
+        assert core_module.DefaultPlanner()(
+            bridge, 'cancel', 'UA-1', {}, lot_id='') is None
+        bridge.db.get.assert_called_once_with('UA-1')
+        assert not bridge.db.save.called
+
+    def test_planning_not_implemented(self):
+        with pytest.raises(NotImplementedError):
+            core_module.DefaultPlanner()(MagicMock(), 'planning', 'UA-1', {})
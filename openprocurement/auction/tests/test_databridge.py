@@ -4,6 +4,7 @@ from gevent import monkey
 monkey.patch_all()
 
 import logging
+import iso8601
 from mock import MagicMock, call
 import pytest
 from openprocurement.auction.databridge import AuctionsDataBridge
@@ -20,10 +21,23 @@ from openprocurement.auction.tests.utils import \
 from openprocurement.auction import core as core_module
 from openprocurement.auction.databridge import LOGGER as databridge_logger
 from openprocurement.auction.core import LOGGER
+from openprocurement.auction.interfaces import IAuctionPlanner
+import openprocurement.auction.helpers.databridge as \
+    databridge_helpers_module
+from openprocurement.auction.helpers.databridge import PlanningPool, \
+    AuctionsIndex, FeedCheckpoint, BloomFilter, RateLimiter, FeedItemsCache, \
+    CheckpointResourceFeeder
+from requests import Session as APISession
 from StringIO import StringIO
+from gevent import sleep, Timeout
+from gevent.event import Event
+from time import time
 
 LOGGER.setLevel(logging.DEBUG)
 
+test_bridge_config_worker_planning = deepcopy(test_bridge_config)
+test_bridge_config_worker_planning['main']['in_process_planning'] = False
+
 
 class TestDatabridgeConfig(object):
     def test_config_init(self, db, bridge):
@@ -150,6 +164,23 @@ class TestDataBridgeFeedItem(object):
              call.mock_mapper(mock_feed_item(bridge['tenders'][0]))]
         )
 
+    @pytest.mark.parametrize(
+        'bridge', [({'tenders': [tender_data_templ, tender_data_templ]})],
+        indirect=['bridge'])
+    def test_unchanged_item_skipped(self, db, bridge):
+        """
+        Test checks that feed item with the same planning fields as
+        the previous one is not passed to the mapper.
+        """
+        mock_mapper = MagicMock()
+        bridge['bridge'].mapper = mock_mapper
+
+        bridge['bridge_thread'].join(0.1)
+
+        assert mock_mapper.call_count == 1
+        assert bridge['bridge'].feed_cache.hits == 1
+        assert bridge['bridge'].feed_cache.misses == 1
+
 
 class TestDataBridgePlanning(object):
     @pytest.mark.parametrize(
@@ -167,6 +198,21 @@ class TestDataBridgePlanning(object):
         # doesn't contain appropriate data
         assert bridge['mock_do_until_success'].call_count == 0
 
+    @pytest.mark.parametrize(
+        'db, bridge',
+        [([{'_id': ID, 'stages': [{'start': '2100-06-28T10:32:19.233669+03:00'}]}],
+          {'tenders': [tender_data_active_auction['tender_data_no_lots']]})],
+        indirect=['db', 'bridge'])
+    def test_already_planned_no_planning(self, db, bridge):
+        """
+        Test checks that the tender which is already planned on the same
+        date (found in the auctions index) is not planned again.
+        """
+        bridge['bridge_thread'].join(0.1)
+
+        assert bridge['bridge'].auctions_index.start
+        assert bridge['mock_do_until_success'].call_count == 0
+
 
 class TestForDataBridgePositive(object):
     @pytest.mark.parametrize(
@@ -234,7 +280,8 @@ class TestForDataBridgePositive(object):
     @pytest.mark.parametrize(
         'db, bridge',
         [([{'_id': '{}_{}'.format(ID, LOT_ID), 'endDate': '2100-06-28T10:32:19.233669+03:00'}],
-          {'tenders': [tender_data_cancelled['tender_data_with_lots']]})],
+          {'tenders': [tender_data_cancelled['tender_data_with_lots']],
+           'bridge_config': test_bridge_config_worker_planning})],
         indirect=['db', 'bridge'])
     def test_cancelled_with_lots(self, db, bridge):
         """Auction has been cancelled with lots"""
@@ -250,7 +297,8 @@ class TestForDataBridgePositive(object):
     @pytest.mark.parametrize(
         'db, bridge',
         [([{'_id': '{}_{}'.format(ID, LOT_ID), 'stages': [{'start': '2100-06-28T10:32:19.233669+03:00'}, 'b', 'c']}],
-          {'tenders': [tender_data_cancelled['tender_data_with_lots']]})],
+          {'tenders': [tender_data_cancelled['tender_data_with_lots']],
+           'bridge_config': test_bridge_config_worker_planning})],
         indirect=['db', 'bridge'])
     def test_cancelled_with_lots_2(self, db, bridge):
         """Auction has been cancelled with lots"""
@@ -266,7 +314,8 @@ class TestForDataBridgePositive(object):
     @pytest.mark.parametrize(
         'db, bridge',
         [([{'_id': ID, 'endDate': '2100-06-28T10:32:19.233669+03:00'}],
-          {'tenders': [tender_data_cancelled['tender_data_no_lots']]})],
+          {'tenders': [tender_data_cancelled['tender_data_no_lots']],
+           'bridge_config': test_bridge_config_worker_planning})],
         indirect=['db', 'bridge'])
     def test_cancelled_no_lots(self, db, bridge):
         """Auction has been cancelled with no lots"""
@@ -282,7 +331,8 @@ class TestForDataBridgePositive(object):
     @pytest.mark.parametrize(
         'db, bridge',
         [([{'_id': ID, 'stages': [{'start': '2100-06-28T10:32:19.233669+03:00'}, 'b', 'c']}],
-          {'tenders': [tender_data_cancelled['tender_data_no_lots']]})],
+          {'tenders': [tender_data_cancelled['tender_data_no_lots']],
+           'bridge_config': test_bridge_config_worker_planning})],
         indirect=['db', 'bridge'])
     def test_cancelled_no_lots_2(self, db, bridge):
         """Auction has been cancelled with no lots"""
@@ -296,6 +346,80 @@ class TestForDataBridgePositive(object):
         )
 
 
+class TestDataBridgeInProcessPlanning(object):
+    @pytest.mark.parametrize(
+        'bridge', [({'tenders': [tender_data_active_auction['tender_data_no_lots']]})],
+        indirect=['bridge'])
+    def test_planner_used_instead_of_worker(self, db, bridge):
+        planner = MagicMock(return_value='ok')
+        core_module.components.registerUtility(
+            planner, IAuctionPlanner, name='default')
+        try:
+            bridge['bridge_thread'].join(0.1)
+        finally:
+            core_module.components.unregisterUtility(
+                planner, IAuctionPlanner, name='default')
+
+        planner.assert_called_once_with(
+            bridge['bridge'], 'planning', ID,
+            bridge['tenders'][0], lot_id='')
+        assert bridge['mock_do_until_success'].call_count == 0
+
+    @pytest.mark.parametrize(
+        'bridge', [({'tenders': [tender_data_active_auction['tender_data_no_lots']]})],
+        indirect=['bridge'])
+    def test_worker_fallback_on_planner_error(self, db, bridge):
+        planner = MagicMock(side_effect=ValueError('boom'))
+        core_module.components.registerUtility(
+            planner, IAuctionPlanner, name='default')
+        try:
+            bridge['bridge_thread'].join(0.1)
+        finally:
+            core_module.components.unregisterUtility(
+                planner, IAuctionPlanner, name='default')
+
+        assert planner.call_count == 1
+        assert bridge['mock_do_until_success'].call_count == 1
+
+
+    @pytest.mark.parametrize(
+        'db, bridge',
+        [([{'_id': '{}_{}'.format(ID, LOT_ID), 'current_stage': 0,
+            'endDate': '2100-06-28T10:32:19.233669+03:00'}],
+          {'tenders': [tender_data_cancelled['tender_data_with_lots']]})],
+        indirect=['db', 'bridge'])
+    def test_default_planner_cancels_in_process(self, db, bridge):
+        bridge['bridge_thread'].join(0.1)
+
+        doc = db.get('{}_{}'.format(ID, LOT_ID))
+        assert doc['current_stage'] == -100
+        assert doc['endDate'] != '2100-06-28T10:32:19.233669+03:00'
+        assert bridge['mock_do_until_success'].call_count == 0
+
+
+class TestDataBridgeRePlanning(object):
+    @pytest.mark.parametrize(
+        'db, bridge',
+        [([{'_id': ID, 'stages': [{'start': '2100-06-28T10:32:19.233669+03:00'}]}],
+          {'re_planning': True,
+           'tenders': [tender_data_active_auction['re_planning'],
+                       tender_data_active_auction['re_planning']]})],
+        indirect=['db', 'bridge'])
+    def test_re_planning_once(self, db, bridge):
+        """
+        Test checks that already planned tender is planned again while
+        re-planning, but only once per re-planning pass.
+        """
+        bridge['bridge_thread'].join(0.1)
+
+        bridge['mock_do_until_success'].assert_called_once_with(
+            core_module.check_call,
+            args=([bridge['bridge_config']['main']['auction_worker'], 'planning', ID,
+                   bridge['bridge_config']['main']['auction_worker_config']],),
+        )
+        assert ID in bridge['bridge'].re_planned_ids
+
+
 # TODO: should be refactored
 class TestForDataBridgeNegative(object):
     @pytest.mark.parametrize(
@@ -344,3 +468,245 @@ class TestForDataBridgeNegative(object):
 
         bridge['bridge_thread'].join(0.1)
         assert(bridge['tenders'][0]['lots'][0]['status'] != 'active')
+
+
+class TestPlanningPool(object):
+    def test_same_tender_commands_are_serialized(self):
+        calls = []
+
+        def command(name):
+            calls.append(('start', name))
+            sleep(0.01)
+            calls.append(('end', name))
+
+        pool = PlanningPool(size=4)
+        pool.add(ID, command, 'planning')
+        pool.add(ID, command, 'cancel')
+        pool.join()
+
+        assert calls == [('start', 'planning'), ('end', 'planning'),
+                         ('start', 'cancel'), ('end', 'cancel')]
+        assert pool.processed == 2
+        assert pool.depth == 0
+
+    def test_different_tenders_run_concurrently(self):
+        running = []
+        max_running = []
+
+        def command():
+            running.append(1)
+            max_running.append(len(running))
+            sleep(0.01)
+            running.pop()
+
+        pool = PlanningPool(size=2)
+        for i in range(4):
+            pool.add('{}-{}'.format(ID, i), command)
+        pool.join()
+
+        assert max(max_running) == 2
+        assert pool.processed == 4
+
+    def test_failed_command_does_not_stop_tender_queue(self):
+        done = []
+
+        def fail():
+            raise ValueError('boom')
+
+        pool = PlanningPool(size=1)
+        pool.add(ID, fail)
+        pool.add(ID, done.append, 'next')
+        pool.join()
+
+        assert done == ['next']
+        assert pool.processed == 2
+
+    def test_done_before(self):
+        pool = PlanningPool(size=2)
+        pool.add(ID, sleep, 0.01)
+        pool.add(LOT_ID, sleep, 0)
+        assert not pool.done_before(1)
+        pool.join()
+        assert pool.done_before(2)
+
+
+class TestAuctionsIndex(object):
+    start = '2100-06-28T10:32:19.233669+03:00'
+
+    def test_update(self):
+        index = AuctionsIndex(MagicMock())
+        index.update({'_id': ID, 'stages': [{'start': self.start}]})
+        assert index.is_planned(ID, iso8601.parse_date(self.start))
+        assert not index.is_planned(
+            ID, iso8601.parse_date('2100-06-28T10:33:19+03:00'))
+
+    def test_update_deleted_or_invalid(self):
+        index = AuctionsIndex(MagicMock())
+        index.update({'_id': ID, 'stages': [{'start': self.start}]})
+        index.update({'_id': ID, '_deleted': True})
+        assert ID not in index.start
+
+        index.update({'_id': ID, 'stages': [{'start': self.start}]})
+        index.update({'_id': ID, 'stages': ['a', 'b']})
+        assert ID not in index.start
+
+    def test_only_future_auctions_kept(self, mocker):
+        mocker.patch.object(databridge_helpers_module, 'startDate_view',
+                            return_value=[MagicMock(id=ID, key=1)])
+        mocker.patch.object(databridge_helpers_module, 'endDate_view',
+                            return_value=[MagicMock(id=ID, key=1)])
+        index = AuctionsIndex(MagicMock())
+        index.build()
+        assert databridge_helpers_module.startDate_view.call_args[1][
+            'startkey'] == index.pruned_at * 1000
+        assert databridge_helpers_module.endDate_view.call_args[1][
+            'startkey'] == index.pruned_at * 1000
+
+        index.update({'_id': LOT_ID,
+                      'stages': [{'start': '2017-06-28T10:00:00+03:00'}]})
+        assert LOT_ID not in index.start
+        assert LOT_ID not in index.end
+        index.prune()
+        assert index.start == {}
+        assert index.end == {}
+
+    def test_design_documents_ignored(self):
+        index = AuctionsIndex(MagicMock())
+        index.update({'_id': '_design/auctions'})
+        assert index.start == {}
+
+    def test_is_scheduled(self):
+        index = AuctionsIndex(MagicMock())
+        index.update({'_id': ID, 'stages': [{'start': self.start}]})
+        index.update({'_id': LOT_ID, 'endDate': '2017-06-28T10:32:19+03:00',
+                      'stages': [{'start': '2017-06-28T10:00:00+03:00'}]})
+        assert index.is_scheduled(ID)
+        assert not index.is_scheduled(LOT_ID)
+        assert not index.is_scheduled('unknown')
+
+
+class TestFeedCheckpoint(object):
+    def test_load_missing(self):
+        db = MagicMock()
+        db.get.return_value = None
+        assert FeedCheckpoint(db, 'auctions').load() is None
+        db.get.assert_called_once_with('_local/feed_checkpoint_auctions')
+
+    def test_save_and_load(self):
+        db = MagicMock()
+        db.get.return_value = None
+        checkpoint = FeedCheckpoint(db, 'auctions')
+        checkpoint.save({'forward': 'f1', 'backward': None})
+        db.save.assert_called_once_with(
+            {'_id': '_local/feed_checkpoint_auctions',
+             'forward': 'f1', 'backward': None})
+
+        db.get.return_value = {'_id': '_local/feed_checkpoint_auctions',
+                               '_rev': '0-1', 'forward': 'f1',
+                               'backward': 'b1'}
+        assert checkpoint.load() == {'forward': 'f1', 'backward': 'b1'}
+
+    def test_bridge_saves_offsets_after_commands_done(self):
+        bridge = MagicMock()
+        bridge.checkpoint_interval = 1
+        bridge._pending_checkpoint = None
+        bridge._items_since_checkpoint = 0
+        bridge.feeder.queue.empty.return_value = True
+        bridge.feeder.offsets = {'forward': 'f1', 'backward': 'b1'}
+        bridge.planning_pool = PlanningPool(size=1)
+        bridge.planning_pool.add(ID, sleep, 0.01)
+
+        AuctionsDataBridge.save_checkpoint.im_func(bridge)
+        assert bridge._pending_checkpoint == (
+            1, {'forward': 'f1', 'backward': 'b1'})
+        assert bridge.checkpoint.save.call_count == 0
+
+        bridge.planning_pool.join()
+        AuctionsDataBridge.save_checkpoint.im_func(bridge)
+        bridge.checkpoint.save.assert_called_once_with(
+            {'forward': 'f1', 'backward': 'b1'})
+
+
+    def test_feeder_uses_shared_session(self):
+        session = APISession()
+        feeder = CheckpointResourceFeeder(
+            host='http://127.0.0.1:6543/', resource='auctions',
+            version='2.4', key='', extra_params=API_EXTRA)
+        feeder.session = session
+        feeder.init_api_clients()
+        assert feeder.forward_client.session is session
+        assert feeder.backward_client.session is session
+        assert feeder.cookies is session.cookies
+        assert session.headers['User-Agent'].startswith('op.client/')
+
+
+class TestRePlanningHelpers(object):
+    def test_bloom_filter(self):
+        seen = BloomFilter(capacity=1000, error_rate=0.01)
+        for i in range(1000):
+            seen.add('{}-{}'.format(ID, i))
+        assert all('{}-{}'.format(ID, i) in seen for i in range(1000))
+        false_positives = sum(
+            '{}-{}'.format(LOT_ID, i) in seen for i in range(1000))
+        assert false_positives < 50
+        assert len(seen) <= 1000
+        assert 0.005 < seen.false_positive_rate < 0.02
+        assert BloomFilter(capacity=1000).false_positive_rate == 0
+
+    def test_rate_limiter(self):
+        limiter = RateLimiter(rate=100)
+        started_at = time()
+        for _ in range(5):
+            limiter.wait()
+        assert time() - started_at >= 0.04
+
+    def test_re_planning_done_without_new_items(self):
+        def resource_items():
+            yield tender_data_active_auction['re_planning']
+            # the forward feed waits for new items forever
+            Event().wait()
+
+        bridge = MagicMock()
+        bridge.feeder.get_resource_items.side_effect = resource_items
+        bridge.feeder.backward_done = True
+        bridge._feed_queue_empty.return_value = True
+        bridge.re_plan.return_value = 1
+        bridge.re_planning_done_check = 0.01
+        bridge.re_planning_progress_interval = 60
+        bridge.re_planned_ids = BloomFilter(capacity=10)
+        bridge.re_planning_skipped = 0
+        with Timeout(1):
+            AuctionsDataBridge.run_re_planning.im_func(bridge)
+        bridge.re_plan.assert_called_once_with(
+            tender_data_active_auction['re_planning'])
+        assert bridge.planning_pool.join.call_count == 1
+
+
+class TestFeedItemsCache(object):
+    fields = API_EXTRA['opt_fields'].split(',')
+
+    def test_changed(self):
+        cache = FeedItemsCache(self.fields)
+        item = deepcopy(tender_data_active_auction['tender_data_no_lots'])
+        assert cache.changed(item)
+        # not planned yet
+        assert cache.changed(item)
+        cache.remember(item)
+        item['dateModified'] = '2100-01-01T00:00:00+03:00'
+        assert not cache.changed(item)
+        item['status'] = 'cancelled'
+        assert cache.changed(item)
+        assert (cache.hits, cache.misses) == (1, 3)
+
+    def test_items_without_id_are_not_cached(self):
+        cache = FeedItemsCache(self.fields)
+        assert cache.changed({})
+        assert cache.changed({})
+
+    def test_lru_eviction(self):
+        cache = FeedItemsCache(self.fields, size=2)
+        for tender_id in ('a', 'b', 'a', 'c'):
+            cache.changed({'id': tender_id, 'status': 'active.auction'})
+            cache.remember({'id': tender_id, 'status': 'active.auction'})
+        assert not cache.changed({'id': 'a', 'status': 'active.auction'})
+        assert cache.changed({'id': 'b', 'status': 'active.auction'})
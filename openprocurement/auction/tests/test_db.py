@@ -38,3 +38,26 @@ class TemplateTestViews(object):
 
     def test_pre_announce_view(self):
         """https://github.com/openprocurement/openprocurement.auction/blob/master/openprocurement/auction/design.py#L31"""
+
+
+@pytest.mark.usefixtures('db')
+class TestViews(object):
+
+    def test_chronograph_start_time_view(self):
+        doc = {'_id': 'waiting', 'current_stage': -1,
+               'stages': [{'start': '2100-06-28T10:32:19.233669+03:00'}]}
+        with put_test_doc(self.db, doc):
+            rows = self.db.view('chronograph/start_time',
+                                startkey=4117851139233,
+                                endkey=4117851139233).rows
+            assert [row.id for row in rows] == ['waiting']
+            assert rows[0].value == self.db.view(
+                'chronograph/start_date').rows[0].value
+
+    def test_pre_announce_by_id_view(self):
+        doc = {'_id': 'tender_lot', 'stages': ['a', 'b', 'c'],
+               'current_stage': 1}
+        with put_test_doc(self.db, doc):
+            rows = self.db.view('auctions/PreAnnounce_by_id',
+                                keys=['tender_lot', 'tender_other_lot']).rows
+            assert [row.id for row in rows] == ['tender_lot']
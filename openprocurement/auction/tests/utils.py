@@ -4,11 +4,15 @@ from requests import Session as Sess
 import os
 from copy import deepcopy
 import yaml
-from openprocurement.auction.helpers.couch import iterview
+from openprocurement.auction.helpers.couch import iterview, iterchanges
 import logging
 from datetime import datetime, timedelta
 import tempfile
+from base64 import b64decode
+from itertools import count
 from dateutil.tz import tzlocal
+from consul.base import ClientError, NotFound
+from gevent.event import Event
 
 
 def read_file_from_json(path):
@@ -46,8 +50,8 @@ API_EXTRA = {'opt_fields': 'status,auctionPeriod,lots,procurementMethodType',
 CONF_FILES_FOLDER = os.path.join(PWD, "data")
 
 
-# with open('data/public_document.json') as _file:
-#     test_public_document = json.load(_file)
+test_public_document = read_file_from_json(
+    os.path.join(CONF_FILES_FOLDER, 'public_document.json'))
 
 
 @contextlib.contextmanager
@@ -136,6 +140,13 @@ def iterview_wrappper(server_url, database_name, view_name,
                     wrapper=wrapper, **options)
 
 
+def iterchanges_wrapper(server_url, database_name, filter_name, since=0,
+                        heartbeat=400, sleep_seconds=0.4, **options):
+    return iterchanges(server_url, database_name, filter_name, since=since,
+                       heartbeat=heartbeat, sleep_seconds=sleep_seconds,
+                       **options)
+
+
 # Data for test with 'active.auction' status
 tender_data_templ = {'id': ID, 'status': 'active.auction'}
 tender_data_wrong_status = {'id': ID, 'status': 'wrong.status'}
@@ -262,3 +273,117 @@ def job_is_active():
 def job_is_not_active():
     resp = test_client.get('active_jobs')
     return len(json.loads(resp.content)) == 0
+
+
+class FakeKV(object):
+
+    def __init__(self, consul):
+        self.consul = consul
+        self.items = {}
+
+    def get(self, key, index=None, wait=None, recurse=False):
+        if index is not None and index >= self.consul.index:
+            # blocking query, answered on the next change or by timeout
+            self.consul.changed.wait(timeout=float(wait.rstrip('s'))
+                                     if wait else None)
+        if recurse:
+            return self.consul.index, [
+                dict(item) for item_key, item in sorted(self.items.items())
+                if item_key.startswith(key)] or None
+        item = self.items.get(key)
+        return self.consul.index, dict(item) if item else None
+
+    def put(self, key, value, acquire=None, cas=None):
+        item = self.items.get(key)
+        if cas is not None and \
+                (item['ModifyIndex'] if item else 0) != cas:
+            return False
+        if acquire:
+            if acquire not in self.consul.session.sessions:
+                return False
+            if item and item.get('Session') not in (None, acquire):
+                return False
+        session = acquire or (item.get('Session') if item else None)
+        self.items[key] = {'Key': key, 'Value': value, 'Session': session,
+                           'ModifyIndex': self.consul.modified()}
+        return True
+
+    def delete(self, key, cas=None):
+        item = self.items.get(key)
+        if cas is not None and (not item or item['ModifyIndex'] != cas):
+            return False
+        if item:
+            del self.items[key]
+            self.consul.modified()
+        return True
+
+
+class FakeSession(object):
+
+    def __init__(self, consul):
+        self.consul = consul
+        self.sessions = set()
+
+    def create(self, name=None, behavior=None, ttl=None):
+        session_id = 'session-{}'.format(self.consul.modified())
+        self.sessions.add(session_id)
+        return session_id
+
+    def renew(self, session_id):
+        if session_id not in self.sessions:
+            raise NotFound('Session id not found')
+        return session_id
+
+    def info(self, session_id):
+        return self.consul.index, \
+            {'ID': session_id} if session_id in self.sessions else None
+
+    def destroy(self, session_id):
+        """Destroy (or expire) the session, its keys are deleted"""
+        self.sessions.discard(session_id)
+        for key, item in self.consul.kv.items.items():
+            if item.get('Session') == session_id:
+                del self.consul.kv.items[key]
+        self.consul.modified()
+
+
+class FakeTxn(object):
+
+    def __init__(self, consul):
+        self.consul = consul
+
+    def put(self, payload):
+        errors = []
+        for i, operation in enumerate(payload):
+            kv = operation['KV']
+            item = self.consul.kv.items.get(kv['Key'])
+            if kv['Session'] not in self.consul.session.sessions or \
+                    item and item.get('Session') not in (None, kv['Session']):
+                errors.append({'OpIndex': i, 'What': 'failed to lock'})
+        if errors:
+            # rolled back, as python-consul reports it
+            raise ClientError('409 ' + json.dumps({'Errors': errors}))
+        for operation in payload:
+            kv = operation['KV']
+            self.consul.kv.put(kv['Key'], b64decode(kv['Value']),
+                               acquire=kv['Session'])
+        return {'Results': [], 'Errors': None}
+
+
+class FakeConsul(object):
+    """In-memory Consul agent: KV store with sessions, lock transactions and
+    blocking queries"""
+
+    def __init__(self, *args, **kwargs):
+        self.indexes = count(1)
+        self.index = next(self.indexes)
+        self.changed = Event()
+        self.kv = FakeKV(self)
+        self.session = FakeSession(self)
+        self.txn = FakeTxn(self)
+
+    def modified(self):
+        self.index = next(self.indexes)
+        changed, self.changed = self.changed, Event()
+        changed.set()
+        return self.index
@@ -21,6 +21,7 @@ from pkg_resources import parse_version
 from restkit.wrappers import BodyWrapper
 from barbecue import chef
 from fractions import Fraction
+from calendar import timegm
 from munch import Munch
 from zope.interface import implementer
 
@@ -90,6 +91,18 @@ def get_time(item):
     return bid_time
 
 
+def timestamp_key(date):
+    """Convert datetime to the key used by the design views keyed by time
+    (milliseconds since epoch, as javascript Date.getTime returns)
+
+    >>> from datetime import datetime
+    >>> from pytz import utc
+    >>> timestamp_key(datetime(2100, 6, 28, 7, 32, 19, 233669, tzinfo=utc))
+    4117851139233
+    """
+    return timegm(date.utctimetuple()) * 1000 + date.microsecond // 1000
+
+
 def sorting_by_amount(bids, reverse=True):
     """
     >>> bids = [
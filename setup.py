@@ -24,7 +24,8 @@ install_requires = [
     'pyopenssl',
     'ndg-httpsclient',
     'pyasn1',
-    'openprocurement_client',
+    # CheckpointResourceFeeder extends ResourceFeeder internals
+    'openprocurement_client>=2.0.0,<2.1',
     'python-consul',
     'retrying',
     'zope.interface',